@@ -1,16 +1,23 @@
 # PART 1/4
 import os
 import shutil
+import tempfile
 import random
 import smtplib
 import json
 import re
+import hashlib
+import time
+import threading
 import urllib.request
 import urllib.error
 from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify, send_file, Response, make_response
 from flask_cors import CORS
-from pymongo import MongoClient, ASCENDING
+from pymongo import MongoClient, ASCENDING, ReturnDocument, UpdateOne, DeleteMany, InsertOne, DeleteOne
+from pymongo.errors import BulkWriteError, OperationFailure
 from bson.objectid import ObjectId
 from datetime import datetime, timedelta
 from pymongo import MongoClient
@@ -89,6 +96,12 @@ teacher_notifications_col = db["teacher_notifications"]
 seating_plans_col = db["seating_plans"]
 grievances_col = db["student_grievances"]
 certificate_access_col = db["certificate_access"]
+certificate_permissions_col = db["certificate_permissions"]
+result_snapshots_col = db["result_snapshots"]
+otp_codes_col = db["otp_codes"]
+otp_deliveries_col = db["otp_deliveries"]
+sms_gateway_state_col = db["sms_gateway_state"]
+migrations_col = db["migrations"]
 
 # Create useful indexes to emulate UNIQUE constraints where used in sqlite
 # Note: index creation is idempotent
@@ -98,7 +111,50 @@ datesheet_col.create_index([("session", ASCENDING), ("class_name", ASCENDING), (
 exam_marks_col.create_index([("session", ASCENDING), ("exam_id", ASCENDING), ("class_name", ASCENDING), ("subject", ASCENDING), ("roll", ASCENDING)], unique=True)
 class_incharge_col.create_index([("session", ASCENDING), ("class_name", ASCENDING)], unique=True)
 teachers_col.create_index([("session", ASCENDING), ("username", ASCENDING)], unique=True)
-timetable_col.create_index([("session", ASCENDING), ("teacher_id", ASCENDING), ("period", ASCENDING), ("class", ASCENDING)])
+_timetable_period_index = "session_1_teacher_id_1_period_1_class_1"
+_timetable_period_keys = [("session", ASCENDING), ("teacher_id", ASCENDING), ("period", ASCENDING), ("class", ASCENDING)]
+# A teacher may hold the same period+class for several day ranges, so the day
+# range is part of the slot key.
+_timetable_slot_index = "session_1_teacher_id_1_period_1_class_1_startDay_1_endDay_1"
+_timetable_slot_keys = _timetable_period_keys + [("startDay", ASCENDING), ("endDay", ASCENDING)]
+
+def ensure_timetable_unique_index():
+    # Make the slot index unique once no duplicate rows are left;
+    # `flask --app app dedupe-timetable` removes exact copies.
+    indexes = timetable_col.index_information()
+    period_info = indexes.get(_timetable_period_index)
+    if period_info and period_info.get("unique"):
+        # Left unique by an earlier version; it would reject rows that differ only by day range.
+        timetable_col.drop_index(_timetable_period_index)
+        timetable_col.create_index(_timetable_period_keys, name=_timetable_period_index)
+    elif not period_info:
+        timetable_col.create_index(_timetable_period_keys, name=_timetable_period_index)
+
+    info = indexes.get(_timetable_slot_index)
+    if info and info.get("unique"):
+        return True
+    duplicates = list(timetable_col.aggregate([
+        {"$group": {
+            "_id": {"s": "$session", "t": "$teacher_id", "p": "$period", "c": "$class", "sd": "$startDay", "ed": "$endDay"},
+            "n": {"$sum": 1}
+        }},
+        {"$match": {"n": {"$gt": 1}}},
+        {"$limit": 1}
+    ]))
+    if duplicates:
+        return False
+    if info:
+        timetable_col.drop_index(_timetable_slot_index)
+    timetable_col.create_index(_timetable_slot_keys, unique=True, name=_timetable_slot_index)
+    return True
+
+try:
+    ensure_timetable_unique_index()
+except Exception:
+    # Avoid startup crash if the index upgrade fails; app can still run.
+    pass
+# Class/period lookups (/timetable/used_days, /timetable/classwise).
+timetable_col.create_index([("session", ASCENDING), ("class", ASCENDING), ("period", ASCENDING)])
 _internal_marks_index_old = "session_1_class_name_1_subject_1_student_id_1"
 _internal_marks_index_new = "session_1_class_name_1_subject_1_exam_name_1_student_id_1"
 try:
@@ -139,8 +195,171 @@ certificate_access_col.create_index(
     [("session", ASCENDING), ("class_name", ASCENDING), ("student_id", ASCENDING), ("certificate_type", ASCENDING)],
     unique=True
 )
+certificate_permissions_col.create_index(
+    [("session", ASCENDING), ("class_name", ASCENDING), ("student_id", ASCENDING)],
+    unique=True
+)
+# Canonical session keys ("2025_26" -> "2025-26"); partial so docs not yet migrated
+# by `flask --app app migrate-session-keys` cannot block startup.
+student_access_col.create_index(
+    [("session_key", ASCENDING), ("class_name", ASCENDING), ("student_id", ASCENDING)],
+    unique=True,
+    partialFilterExpression={"session_key": {"$exists": True}}
+)
+certificate_permissions_col.create_index(
+    [("session_key", ASCENDING), ("class_name", ASCENDING), ("student_id", ASCENDING)],
+    unique=True,
+    partialFilterExpression={"session_key": {"$exists": True}}
+)
+otp_codes_col.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+# Delivery job records are only useful while the client polls them.
+otp_deliveries_col.create_index([("created_at", ASCENDING)], expireAfterSeconds=86400)
+result_snapshots_col.create_index(
+    [("session_key", ASCENDING), ("class_name", ASCENDING), ("exam_name", ASCENDING), ("student_key", ASCENDING)],
+    unique=True
+)
+try:
+    # Lives on the student cluster; backs the admission_no lookups for certificate checks.
+    students_col.create_index([("admission_no", ASCENDING)])
+except Exception:
+    pass
+
+# ---------------------------
+# In-process caches
+# ---------------------------
+CACHE_REGISTRY = {}
+
+class TTLCache:
+    """Small thread-safe in-process cache with per-entry TTL and LRU eviction."""
+
+    def __init__(self, name, ttl_seconds, max_entries=256):
+        self.name = name
+        self.ttl_seconds = float(ttl_seconds)
+        self.max_entries = max(1, int(max_entries))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        CACHE_REGISTRY[name] = self
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "ttl_sec": self.ttl_seconds,
+                "max_entries": self.max_entries
+            }
 
-OTP_STORE = {}
+# ---------------------------
+# OTP store (shared across gunicorn workers / Cloud Run instances)
+# ---------------------------
+OTP_MAX_ATTEMPTS = 5
+
+class MemoryOtpStore:
+    """Process-local OTP store; only correct with a single worker (local dev)."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, otp, expires_at, **extra):
+        with self._lock:
+            self._data[key] = {"otp": otp, "expires_at": expires_at, "attempts": 0, **extra}
+
+    def verify(self, key, otp):
+        with self._lock:
+            rec = self._data.get(key)
+            if not rec:
+                return "missing"
+            if datetime.utcnow() > rec["expires_at"]:
+                self._data.pop(key, None)
+                return "expired"
+            if rec.get("attempts", 0) >= OTP_MAX_ATTEMPTS:
+                self._data.pop(key, None)
+                return "locked"
+            if otp != rec.get("otp"):
+                rec["attempts"] = rec.get("attempts", 0) + 1
+                return "invalid"
+            self._data.pop(key, None)
+            return "ok"
+
+
+class MongoOtpStore:
+    """OTP store backed by a TTL collection so every worker sees the same codes."""
+
+    def __init__(self, col):
+        self.col = col
+
+    @staticmethod
+    def _hash(key, otp):
+        return hashlib.sha256(f"{key}:{otp}".encode("utf-8")).hexdigest()
+
+    def put(self, key, otp, expires_at, **extra):
+        self.col.replace_one(
+            {"_id": key},
+            {
+                "otp_hash": self._hash(key, otp),
+                "expires_at": expires_at,
+                "attempts": 0,
+                "created_at": datetime.utcnow(),
+                **extra
+            },
+            upsert=True
+        )
+
+    def verify(self, key, otp):
+        now = datetime.utcnow()
+        live = {"_id": key, "expires_at": {"$gt": now}, "attempts": {"$lt": OTP_MAX_ATTEMPTS}}
+        # Success consumes the code atomically, so it cannot be used twice.
+        if self.col.find_one_and_delete({**live, "otp_hash": self._hash(key, otp)}):
+            return "ok"
+        if self.col.find_one_and_update(live, {"$inc": {"attempts": 1}}, return_document=ReturnDocument.AFTER):
+            return "invalid"
+        rec = self.col.find_one_and_delete({"_id": key})
+        if not rec:
+            return "missing"
+        if rec.get("expires_at") and rec["expires_at"] <= now:
+            return "expired"
+        return "locked"
+
+
+if str(os.environ.get("OTP_STORE_BACKEND", "mongo")).strip().lower() == "memory":
+    OTP_STORE = MemoryOtpStore()
+else:
+    OTP_STORE = MongoOtpStore(otp_codes_col)
 SPECIAL_OTP_USERS = {"PSPSLIB", "PSPSSTU", "PSPSTEA", "ADMIN", "PRINCIPAL"}
 
 def mask_mobile(mobile):
@@ -364,6 +583,73 @@ def collect_known_class_names(session=""):
 
     return sorted(normalized, key=class_sort_key)
 
+# ---------------------------
+# Teacher profile mirror (student DB teachers, indexed in memory)
+# ---------------------------
+TEACHER_PROFILE_FIELDS = {
+    "_id": 0,
+    "teacher_code": 1,
+    "employee_id": 1,
+    "teacher_name": 1,
+    "mobile": 1,
+    "photo_url": 1,
+    "dob": 1,
+    "date_of_birth": 1
+}
+TEACHER_PROFILE_MISS_REFRESH_SEC = 30
+teacher_profile_index_cache = TTLCache("teacher_profile_index", ttl_seconds=300, max_entries=1)
+_teacher_profile_index_lock = threading.Lock()
+_teacher_profile_index_built_at = 0.0
+
+def teacher_profile_name_key(name):
+    return " ".join(str(name or "").split()).upper()
+
+def build_teacher_profile_index():
+    global _teacher_profile_index_built_at
+    index = {"teacher_code": {}, "employee_id": {}, "teacher_name": {}}
+    for doc in student_teachers_col.find({}, TEACHER_PROFILE_FIELDS):
+        # First document wins, matching what find_one returned before.
+        for field in ("teacher_code", "employee_id"):
+            key = str(doc.get(field, "") or "").strip()
+            if key:
+                index[field].setdefault(key, doc)
+        name_key = teacher_profile_name_key(doc.get("teacher_name"))
+        if name_key:
+            index["teacher_name"].setdefault(name_key, doc)
+    teacher_profile_index_cache.set("index", index)
+    _teacher_profile_index_built_at = time.monotonic()
+    return index
+
+def get_teacher_profile_index(max_age=None):
+    def fresh():
+        if max_age is not None and time.monotonic() - _teacher_profile_index_built_at > max_age:
+            return None
+        return teacher_profile_index_cache.get("index")
+
+    index = fresh()
+    if index is not None:
+        return index
+    with _teacher_profile_index_lock:
+        # Another request may have rebuilt it while we waited.
+        index = fresh()
+        if index is None:
+            index = build_teacher_profile_index()
+        return index
+
+def lookup_teacher_profile(index, teacher_code, username, display_name):
+    lookups = []
+    if teacher_code:
+        lookups.extend([("teacher_code", teacher_code), ("employee_id", teacher_code)])
+    if username:
+        lookups.append(("employee_id", username))
+    if display_name:
+        lookups.append(("teacher_name", teacher_profile_name_key(display_name)))
+    for field, key in lookups:
+        profile = index[field].get(key)
+        if profile:
+            return profile
+    return None
+
 def find_student_teacher_profile(exam_teacher):
     if not exam_teacher:
         return {}
@@ -372,22 +658,13 @@ def find_student_teacher_profile(exam_teacher):
     username = str(exam_teacher.get("username", "")).strip()
     display_name = str(exam_teacher.get("name", "")).strip()
 
-    lookup_filters = []
-    if teacher_code:
-        lookup_filters.extend([
-            {"teacher_code": teacher_code},
-            {"employee_id": teacher_code}
-        ])
-    if username:
-        lookup_filters.append({"employee_id": username})
-    if display_name:
-        lookup_filters.append({"teacher_name": {"$regex": f"^{re.escape(display_name)}$", "$options": "i"}})
-
     profile = None
-    for q in lookup_filters:
-        profile = student_teachers_col.find_one(q)
-        if profile:
-            break
+    if teacher_code or username or display_name:
+        profile = lookup_teacher_profile(get_teacher_profile_index(), teacher_code, username, display_name)
+        # A teacher added on the student side since the last refresh; rebuild at most every 30s.
+        if not profile and time.monotonic() - _teacher_profile_index_built_at > TEACHER_PROFILE_MISS_REFRESH_SEC:
+            index = get_teacher_profile_index(max_age=TEACHER_PROFILE_MISS_REFRESH_SEC)
+            profile = lookup_teacher_profile(index, teacher_code, username, display_name)
 
     return {
         "teacher_name": (profile or {}).get("teacher_name") or display_name or username,
@@ -423,6 +700,106 @@ def _is_sms_response_success(data):
             return True
     return False
 
+# ---------------------------
+# TextBee route memo: remembers which endpoint/auth/payload shape worked
+# ---------------------------
+TEXTBEE_REDISCOVER_AFTER = max(1, int(os.environ.get("TEXTBEE_REDISCOVER_AFTER", "3") or 3))
+_textbee_route = {}
+_textbee_route_lock = threading.Lock()
+
+def textbee_config_fingerprint(api_url, api_key, device_id):
+    # Hashed so the API key never lands in Mongo; any config change invalidates the route.
+    return hashlib.sha256(f"{api_url}|{api_key}|{device_id}".encode("utf-8")).hexdigest()
+
+def get_textbee_route(fingerprint):
+    with _textbee_route_lock:
+        if _textbee_route.get("fingerprint") == fingerprint:
+            return dict(_textbee_route)
+    try:
+        doc = sms_gateway_state_col.find_one({"_id": "textbee", "fingerprint": fingerprint})
+    except Exception:
+        doc = None
+    if not doc:
+        return None
+    route = {
+        "fingerprint": fingerprint,
+        "endpoint": doc.get("endpoint", ""),
+        "auth_index": int(doc.get("auth_index", 0)),
+        "payload_index": int(doc.get("payload_index", 0)),
+        "failures": int(doc.get("failures", 0))
+    }
+    with _textbee_route_lock:
+        _textbee_route.clear()
+        _textbee_route.update(route)
+    return dict(route)
+
+def save_textbee_route(fingerprint, endpoint, auth_index, payload_index):
+    route = {
+        "fingerprint": fingerprint,
+        "endpoint": endpoint,
+        "auth_index": auth_index,
+        "payload_index": payload_index,
+        "failures": 0
+    }
+    with _textbee_route_lock:
+        _textbee_route.clear()
+        _textbee_route.update(route)
+    try:
+        sms_gateway_state_col.replace_one(
+            {"_id": "textbee"},
+            {**route, "updated_at": datetime.utcnow()},
+            upsert=True
+        )
+    except Exception:
+        pass
+
+def record_textbee_route_result(fingerprint, ok):
+    """Track consecutive failures of the memoized route; returns the current count."""
+    with _textbee_route_lock:
+        if _textbee_route.get("fingerprint") != fingerprint:
+            return 0
+        if ok and not _textbee_route.get("failures"):
+            return 0
+        _textbee_route["failures"] = 0 if ok else int(_textbee_route.get("failures", 0)) + 1
+        failures = _textbee_route["failures"]
+    try:
+        sms_gateway_state_col.update_one(
+            {"_id": "textbee", "fingerprint": fingerprint},
+            {"$set": {"failures": failures, "updated_at": datetime.utcnow()}}
+        )
+    except Exception:
+        pass
+    return failures
+
+def _post_textbee(endpoint, headers, payload, request_timeout):
+    req = urllib.request.Request(
+        endpoint,
+        data=json.dumps(payload).encode("utf-8"),
+        headers=headers,
+        method="POST"
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=request_timeout) as resp:
+            body = resp.read().decode("utf-8", errors="ignore")
+            parsed = {}
+            try:
+                parsed = json.loads(body) if body else {}
+            except Exception:
+                parsed = {}
+            if 200 <= resp.status < 300 and (not parsed or _is_sms_response_success(parsed)):
+                return True, ""
+            if 200 <= resp.status < 300 and parsed:
+                return True, ""
+            return False, body or f"http {resp.status}"
+    except urllib.error.HTTPError as e:
+        try:
+            err_body = e.read().decode("utf-8", errors="ignore")
+        except Exception:
+            err_body = str(e)
+        return False, f"{endpoint} :: {err_body or str(e)}"
+    except Exception as e:
+        return False, f"{endpoint} :: {str(e)}"
+
 def send_textbee_otp(mobile, otp_code, teacher_name):
     api_url = str(os.environ.get("TEXTBEE_API_URL", "")).strip()
     api_key = str(os.environ.get("TEXTBEE_API_KEY", "")).strip()
@@ -493,41 +870,41 @@ def send_textbee_otp(mobile, otp_code, teacher_name):
 
     request_timeout = float(os.environ.get("TEXTBEE_TIMEOUT_SEC", "4"))
     max_attempts = int(os.environ.get("TEXTBEE_MAX_ATTEMPTS", "12"))
+    fingerprint = textbee_config_fingerprint(api_url, api_key, device_id)
+
+    # Fast path: one call on the route that worked last time.
+    route = get_textbee_route(fingerprint)
+    if (
+        route
+        and route["endpoint"] in endpoint_candidates
+        and 0 <= route["auth_index"] < len(auth_variants)
+        and 0 <= route["payload_index"] < len(payloads)
+    ):
+        ok, err = _post_textbee(
+            route["endpoint"],
+            auth_variants[route["auth_index"]],
+            payloads[route["payload_index"]],
+            request_timeout
+        )
+        if ok:
+            record_textbee_route_result(fingerprint, True)
+            return True, ""
+        if record_textbee_route_result(fingerprint, False) < TEXTBEE_REDISCOVER_AFTER:
+            return False, err
+
     attempts = 0
     last_err = "SMS send failed"
     for endpoint in endpoint_candidates:
-        for headers in auth_variants:
-            for payload in payloads:
+        for auth_index, headers in enumerate(auth_variants):
+            for payload_index, payload in enumerate(payloads):
                 if attempts >= max_attempts:
                     return False, last_err
                 attempts += 1
-                req = urllib.request.Request(
-                    endpoint,
-                    data=json.dumps(payload).encode("utf-8"),
-                    headers=headers,
-                    method="POST"
-                )
-                try:
-                    with urllib.request.urlopen(req, timeout=request_timeout) as resp:
-                        body = resp.read().decode("utf-8", errors="ignore")
-                        parsed = {}
-                        try:
-                            parsed = json.loads(body) if body else {}
-                        except Exception:
-                            parsed = {}
-                        if 200 <= resp.status < 300 and (not parsed or _is_sms_response_success(parsed)):
-                            return True, ""
-                        if 200 <= resp.status < 300 and parsed:
-                            return True, ""
-                        last_err = body or f"http {resp.status}"
-                except urllib.error.HTTPError as e:
-                    try:
-                        err_body = e.read().decode("utf-8", errors="ignore")
-                    except Exception:
-                        err_body = str(e)
-                    last_err = f"{endpoint} :: {err_body or str(e)}"
-                except Exception as e:
-                    last_err = f"{endpoint} :: {str(e)}"
+                ok, err = _post_textbee(endpoint, headers, payload, request_timeout)
+                if ok:
+                    save_textbee_route(fingerprint, endpoint, auth_index, payload_index)
+                    return True, ""
+                last_err = err
 
     return False, last_err
 
@@ -553,6 +930,7 @@ def get_teacher_otp_config_status():
         "device_id_set": bool(device_id),
         "timeout_sec": timeout_sec,
         "max_attempts": max_attempts,
+        "route_cached": bool(api_url and api_key and get_textbee_route(textbee_config_fingerprint(api_url, api_key, device_id))),
         "missing": missing
     }
 
@@ -634,6 +1012,125 @@ def _teacher_password_matches(name, dob, raw_password, teacher_code=""):
             return True
     return False
 
+# ---------------------------
+# SMTP connection pool (OTP email)
+# ---------------------------
+class SmtpConnectionPool:
+    """Keeps logged-in SMTP connections open between OTP emails; LIFO, NOOP-checked on checkout."""
+
+    def __init__(self, host, port, user, password, starttls=True, max_idle=4, idle_timeout=240, timeout=20):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.starttls:
+                conn.starttls()
+            if self.user:
+                conn.login(self.user, self.password)
+        except Exception:
+            self._close(conn)
+            raise
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.quit()
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _is_connection_error(err):
+        if isinstance(err, (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)):
+            return True
+        return isinstance(err, smtplib.SMTPResponseException) and err.smtp_code == 421
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+            if time.monotonic() - last_used > self.idle_timeout:
+                self._close(conn)
+                continue
+            try:
+                if conn.noop()[0] == 250:
+                    return conn
+            except Exception:
+                pass
+            self._close(conn)
+        return self._connect()
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((conn, time.monotonic()))
+                return
+        self._close(conn)
+
+    def send(self, from_email, to_emails, message):
+        conn = self._acquire()
+        try:
+            conn.sendmail(from_email, to_emails, message)
+        except Exception as e:
+            self._close(conn)
+            if not self._is_connection_error(e):
+                raise
+            # The server dropped a pooled connection mid-send; retry once on a fresh one.
+            conn = self._connect()
+            try:
+                conn.sendmail(from_email, to_emails, message)
+            except Exception:
+                self._close(conn)
+                raise
+        self._release(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+
+_smtp_pool = None
+_smtp_pool_key = None
+_smtp_pool_lock = threading.Lock()
+
+def get_smtp_pool(smtp_host, smtp_port, smtp_user, smtp_pass):
+    """Shared pool for the current SMTP config; rebuilt when the config changes."""
+    global _smtp_pool, _smtp_pool_key
+    starttls = to_bool(os.environ.get("OTP_SMTP_STARTTLS"), True)
+    key = (smtp_host, smtp_port, smtp_user, hashlib.sha256(smtp_pass.encode("utf-8")).hexdigest(), starttls)
+    with _smtp_pool_lock:
+        if _smtp_pool is None or _smtp_pool_key != key:
+            old_pool = _smtp_pool
+            _smtp_pool = SmtpConnectionPool(
+                smtp_host,
+                smtp_port,
+                smtp_user,
+                smtp_pass,
+                starttls=starttls,
+                max_idle=max(1, int(os.environ.get("OTP_SMTP_POOL_SIZE", "4") or 4))
+            )
+            _smtp_pool_key = key
+            if old_pool:
+                old_pool.close_all()
+        return _smtp_pool
+
 def send_otp_email(to_email, otp_code, username):
     smtp_host = os.environ.get("OTP_SMTP_HOST", "smtp.gmail.com")
     smtp_port = int(os.environ.get("OTP_SMTP_PORT", "587"))
@@ -656,10 +1153,7 @@ def send_otp_email(to_email, otp_code, username):
     msg["To"] = to_email
 
     try:
-        with smtplib.SMTP(smtp_host, smtp_port, timeout=20) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_pass)
-            server.sendmail(from_email, [to_email], msg.as_string())
+        get_smtp_pool(smtp_host, smtp_port, smtp_user, smtp_pass).send(from_email, [to_email], msg.as_string())
         return True, ""
     except Exception as e:
         return False, str(e)
@@ -757,6 +1251,20 @@ def session_variants(session_value):
         return [s]
     return [s, alt]
 
+def canonical_session(session_value):
+    # "2025_26" and "2025-26" are the same academic session.
+    return clean_text(session_value).replace("_", "-")
+
+def session_key_filter(session_value):
+    # Keyed docs match on session_key; docs the session_key backfill has not
+    # reached yet (e.g. written by an older instance mid-deploy) still match
+    # on their raw session spelling.
+    session_key = canonical_session(session_value)
+    return {"$or": [
+        {"session_key": session_key},
+        {"session": {"$in": session_variants(session_key) or [session_key]}, "session_key": {"$exists": False}}
+    ]}
+
 def normalize_student_id(raw):
     if raw is None:
         return ""
@@ -774,26 +1282,7 @@ def normalize_student_id(raw):
     except Exception:
         return ""
 
-def get_student_access_flags(student_doc):
-    session = student_doc.get("session", "")
-    class_name = student_doc.get("class_name", "")
-    student_id = str(student_doc.get("_id", ""))
-
-    access_doc = None
-    if class_name and student_id:
-        sessions = session_variants(session)
-        if sessions:
-            access_doc = student_access_col.find_one({
-                "session": {"$in": sessions},
-                "class_name": class_name,
-                "student_id": student_id
-            })
-        else:
-            access_doc = student_access_col.find_one({
-                "class_name": class_name,
-                "student_id": student_id
-            })
-
+def access_flags_from_doc(access_doc):
     eligible = to_bool(access_doc.get("eligible"), False) if access_doc else False
     release_rollno = to_bool(access_doc.get("release_rollno"), False) if access_doc else False
     release_result = to_bool(access_doc.get("release_result"), False) if access_doc else False
@@ -809,6 +1298,62 @@ def get_student_access_flags(student_doc):
         "release_result": release_result
     }
 
+def resolve_student_access_flags(student_docs):
+    # Group students by (session key, class) so each group costs one $in query
+    # instead of one find_one per student; the join happens in memory.
+    groups = {}
+    for s in student_docs:
+        class_name = s.get("class_name", "")
+        student_id = str(s.get("_id", ""))
+        if not class_name or not student_id:
+            continue
+        key = (canonical_session(s.get("session", "")), class_name)
+        groups.setdefault(key, set()).add(student_id)
+
+    access_map = {}
+    for (session_key, class_name), student_ids in groups.items():
+        query = {"class_name": class_name, "student_id": {"$in": list(student_ids)}}
+        if session_key:
+            query.update(session_key_filter(session_key))
+        for doc in student_access_col.find(query):
+            map_key = (session_key, class_name, doc.get("student_id"))
+            if map_key not in access_map:
+                access_map[map_key] = doc
+
+    out = {}
+    for s in student_docs:
+        student_id = str(s.get("_id", ""))
+        map_key = (canonical_session(s.get("session", "")), s.get("class_name", ""), student_id)
+        out[student_id] = access_flags_from_doc(access_map.get(map_key))
+    return out
+
+def get_student_access_flags(student_doc):
+    student_id = str(student_doc.get("_id", ""))
+    return resolve_student_access_flags([student_doc]).get(student_id) or access_flags_from_doc(None)
+
+# ---------------------------
+# Exam metadata cache (exams change a few times a year)
+# ---------------------------
+exam_cache = TTLCache(
+    "exam_metadata",
+    ttl_seconds=int(os.environ.get("EXAM_CACHE_TTL_SEC", "60")),
+    max_entries=int(os.environ.get("EXAM_CACHE_MAX_ENTRIES", "512"))
+)
+
+def get_exam_doc(session, exam_name, fresh=False):
+    # Misses are not cached so a newly created exam shows up on every worker.
+    # Write paths pass fresh=True: delete/create on another worker changes the
+    # exam _id, and marks must never be written under a dead one.
+    key = (session, exam_name)
+    exam = None if fresh else exam_cache.get(key)
+    if exam is None:
+        exam = exams_col.find_one({"exam_name": exam_name, "session": session})
+        if exam:
+            exam_cache.set(key, exam)
+        else:
+            exam_cache.pop(key)
+    return exam
+
 # ---------------------------
 # Create exam (equivalent to /exam/create)
 # ---------------------------
@@ -841,6 +1386,7 @@ def create_exam():
         "created_at": datetime.utcnow()
     }
     res = exams_col.insert_one(doc)
+    exam_cache.clear()
     return jsonify({"success": True, "exam_id": str(res.inserted_id)})
 
 # ---------------------------
@@ -860,6 +1406,7 @@ def delete_exam(exam_id):
 
     # remove exam document
     exams_col.delete_one({"_id": obj})
+    exam_cache.clear()
 
     # remove datesheet entries tied to exam_name + session
     datesheet_col.delete_many({"exam_name": exam.get("exam_name"), "session": exam.get("session")})
@@ -987,7 +1534,7 @@ def get_datesheet():
         return jsonify({"success": False, "message": "Missing parameters"}), 400
 
     # 1) Fetch exam info (time, total marks)
-    exam_doc = exams_col.find_one({"exam_name": exam_name, "session": session})
+    exam_doc = get_exam_doc(session, exam_name)
     if not exam_doc:
         return jsonify({"success": False, "message": "Exam not found"}), 404
 
@@ -1020,6 +1567,170 @@ def get_datesheet():
 
     return jsonify({"success": True, "datesheet": final})
 
+# ---------------------------
+# Datesheet for every class of an exam (one aggregation)
+# ---------------------------
+@app.route("/exam/get-datesheet-all", methods=["GET"])
+def get_datesheet_all():
+    session = request.args.get("session")
+    exam_name = request.args.get("exam_name")
+
+    if not session or not exam_name:
+        return jsonify({"success": False, "message": "Missing parameters"}), 400
+
+    exam_doc = get_exam_doc(session, exam_name)
+    if not exam_doc:
+        return jsonify({"success": False, "message": "Exam not found"}), 404
+
+    exam_time = exam_doc.get("exam_time", "")
+    total_marks = exam_doc.get("total_marks", "")
+
+    pipeline = [
+        {"$match": {"session": session}},
+        {"$lookup": {
+            "from": datesheet_col.name,
+            "let": {"cls": "$class_name", "sub": "$subject"},
+            "pipeline": [
+                {"$match": {
+                    "session": session,
+                    "exam_name": exam_name,
+                    "$expr": {"$and": [
+                        {"$eq": ["$class_name", "$$cls"]},
+                        {"$eq": ["$subject", "$$sub"]}
+                    ]}
+                }},
+                {"$project": {"_id": 0, "date": 1}},
+                {"$limit": 1}
+            ],
+            "as": "ds"
+        }},
+        {"$group": {
+            "_id": "$class_name",
+            "datesheet": {"$push": {
+                "subject": "$subject",
+                "date": {"$ifNull": [{"$arrayElemAt": ["$ds.date", 0]}, ""]}
+            }}
+        }}
+    ]
+
+    classes = []
+    for row in exam_subjects_col.aggregate(pipeline):
+        classes.append({
+            "class_name": row.get("_id"),
+            "datesheet": [
+                {
+                    "subject": item.get("subject"),
+                    "date": item.get("date") or "",
+                    "total_marks": total_marks,
+                    "duration": exam_time
+                }
+                for item in row.get("datesheet", [])
+            ]
+        })
+    classes.sort(key=lambda c: class_sort_key(c["class_name"]))
+
+    return jsonify({"success": True, "exam_name": exam_name, "session": session, "classes": classes})
+
+# ---------------------------
+# Import subjects + datesheet for all classes from Excel (one sheet per class)
+# ---------------------------
+@app.route("/exam/import-datesheet-excel", methods=["POST"])
+def import_datesheet_excel():
+    session = clean_text(request.form.get("session"))
+    exam_name = clean_text(request.form.get("exam_name"))
+    file = request.files.get("file")
+
+    if not session or not exam_name:
+        return jsonify({"success": False, "message": "Session and exam name are required"}), 400
+    if not file:
+        return jsonify({"success": False, "message": "Excel file is required"}), 400
+
+    try:
+        wb = load_workbook(file, read_only=True, data_only=True)
+    except Exception as e:
+        return jsonify({"success": False, "message": f"Invalid Excel file: {e}"}), 400
+
+    # class_name -> {subject_key: (subject, date)}; rows are streamed, not loaded per sheet
+    parsed = {}
+    skipped_rows = []
+    try:
+        for ws in wb.worksheets:
+            sheet_class = normalize_class_name(ws.title)
+            for row_no, row in enumerate(ws.iter_rows(values_only=True), start=1):
+                cells = list(row[:3])
+                while len(cells) < 3:
+                    cells.append(None)
+                class_cell, subject_cell, date_cell = cells
+                class_name = clean_text(class_cell)
+                subject = clean_text(subject_cell)
+                if isinstance(date_cell, datetime):
+                    date = date_cell.strftime("%Y-%m-%d")
+                else:
+                    date = clean_text(date_cell)
+
+                if not any([class_name, subject, date]):
+                    continue
+                if [class_name.upper(), subject.upper(), date.upper()] == ["CLASS", "SUBJECT", "DATE"]:
+                    continue
+
+                class_name = normalize_class_name(class_name or sheet_class)
+                if not class_name or not subject:
+                    skipped_rows.append(f"{ws.title} row {row_no}")
+                    continue
+
+                subjects = parsed.setdefault(class_name, {})
+                subject_key = normalize_subject_name(subject)
+                first_subject, first_date = subjects.get(subject_key, (subject, ""))
+                subjects[subject_key] = (first_subject, date or first_date)
+    finally:
+        wb.close()
+
+    if not parsed:
+        return jsonify({
+            "success": False,
+            "message": "No valid datesheet rows found in Excel file",
+            "skipped_rows": skipped_rows
+        }), 400
+
+    subject_ops = []
+    datesheet_ops = []
+    for class_name, subjects in parsed.items():
+        subject_ops.append(DeleteMany({"session": session, "class_name": class_name}))
+        datesheet_ops.append(DeleteMany({"session": session, "class_name": class_name, "exam_name": exam_name}))
+        for subject_key, (subject, date) in subjects.items():
+            subject_ops.append(InsertOne({
+                "session": session,
+                "class_name": class_name,
+                "subject": subject,
+                "subject_key": subject_key
+            }))
+            if date:
+                datesheet_ops.append(InsertOne({
+                    "session": session,
+                    "class_name": class_name,
+                    "exam_name": exam_name,
+                    "subject": subject,
+                    "date": date,
+                    "total_marks": 0,
+                    "duration": 0
+                }))
+
+    # ordered so each class's delete runs before its inserts
+    try:
+        exam_subjects_col.bulk_write(subject_ops, ordered=True)
+        datesheet_col.bulk_write(datesheet_ops, ordered=True)
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)}), 500
+
+    return jsonify({
+        "success": True,
+        "message": "Datesheet imported successfully",
+        "classes": sorted(parsed, key=class_sort_key),
+        "subjects": sum(len(v) for v in parsed.values()),
+        "dated_subjects": sum(1 for v in parsed.values() for _, date in v.values() if date),
+        "skipped_rows": skipped_rows
+    })
+
 @app.route("/portal/student/<student_id>", methods=["GET"])
 def portal_get_student(student_id):
     try:
@@ -1052,26 +1763,155 @@ def portal_get_student(student_id):
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
+PORTAL_STUDENT_FIELDS = {
+    "student_name": 1,
+    "admission_no": 1,
+    "class_name": 1,
+    "section": 1,
+    "rollno": 1,
+    "photo_url": 1,
+    "session": 1,
+}
+PORTAL_STUDENTS_BATCH = 500
+PORTAL_STUDENTS_MAX_LIMIT = 1000
+
+def portal_student_row(s, access):
+    return {
+        "id": str(s["_id"]),
+        "name": s.get("student_name"),
+        "admission_no": s.get("admission_no", ""),
+        "class_name": s.get("class_name"),
+        "section": s.get("section"),
+        "roll": s.get("rollno", ""),
+        "photo_url": s.get("photo_url", ""),
+        "session": s.get("session"),
+        "eligible": access.get("eligible", False),
+        "release_rollno": access.get("release_rollno", False),
+        "release_result": access.get("release_result", False)
+    }
+
+def iter_portal_student_rows(cursor, batch_size=PORTAL_STUDENTS_BATCH):
+    # Resolve access flags one batch at a time so only a batch of students is held in memory.
+    def flush(batch):
+        access_map = resolve_student_access_flags(batch)
+        for s in batch:
+            yield portal_student_row(s, access_map.get(str(s["_id"])) or access_flags_from_doc(None))
+
+    batch = []
+    for s in cursor:
+        batch.append(s)
+        if len(batch) >= batch_size:
+            yield from flush(batch)
+            batch = []
+    if batch:
+        yield from flush(batch)
+
 @app.route("/portal/students", methods=["GET"])
 def portal_list_students():
+    """
+    Query params (all optional):
+        session=2025-26
+        class_name=5th
+        after=<last student id from previous page>
+        limit=200
+    Send "Accept: application/x-ndjson" to stream one student per line.
+    """
+    session = clean_text(request.args.get("session"))
+    class_name = clean_text(request.args.get("class_name"))
+    after = clean_text(request.args.get("after"))
+    raw_limit = clean_text(request.args.get("limit"))
+
+    query = {}
+    if session:
+        query["session"] = {"$in": session_variants(session)}
+    if class_name:
+        query["class_name"] = class_name
+    if after:
+        if not ObjectId.is_valid(after):
+            return jsonify({"success": False, "message": "Invalid cursor", "students": []}), 400
+        query["_id"] = {"$gt": ObjectId(after)}
+
+    limit = 0
+    if raw_limit:
+        try:
+            limit = max(1, min(int(raw_limit), PORTAL_STUDENTS_MAX_LIMIT))
+        except ValueError:
+            return jsonify({"success": False, "message": "Invalid limit", "students": []}), 400
+
+    cursor = students_col.find(query, PORTAL_STUDENT_FIELDS).sort("_id", ASCENDING).batch_size(PORTAL_STUDENTS_BATCH)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    if "application/x-ndjson" in request.headers.get("Accept", ""):
+        def generate():
+            for row in iter_portal_student_rows(cursor):
+                yield json.dumps(row) + "\n"
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    students = list(iter_portal_student_rows(cursor))
+    next_cursor = students[-1]["id"] if limit and len(students) == limit else None
+    return jsonify({"success": True, "students": students, "next_cursor": next_cursor})
+
+# ---------------------------
+# Class roster cache (student cluster)
+# ---------------------------
+ROSTER_FIELDS = {
+    "student_name": 1,
+    "name": 1,
+    "father_name": 1,
+    "admission_no": 1,
+    "class_name": 1,
+    "section": 1,
+    "rollno": 1,
+    "photo_url": 1,
+    "session": 1,
+}
+roster_cache = TTLCache(
+    "class_roster",
+    ttl_seconds=int(os.environ.get("ROSTER_CACHE_TTL_SEC", "120")),
+    max_entries=int(os.environ.get("ROSTER_CACHE_MAX_ENTRIES", "256"))
+)
+
+def roll_sort_key(value):
+    try:
+        return int(str(value if value is not None else "").strip())
+    except Exception:
+        return 10**9
+
+def get_class_roster(session, class_name):
+    # Returns projected students of a class sorted by roll number. The tuple is
+    # shared between requests, so callers must not mutate the rows.
+    class_name = clean_text(class_name)
+    key = (canonical_session(session), class_name)
+    roster = roster_cache.get(key)
+    if roster is not None:
+        return roster
+
+    sessions = session_variants(session)
     students = []
-    for s in students_col.find():
-        access = get_student_access_flags(s)
-        roll_value = s.get("rollno", "")
-        students.append({
-            "id": str(s["_id"]),
-            "name": s.get("student_name"),
-            "admission_no": s.get("admission_no", ""),
-            "class_name": s.get("class_name"),
-            "section": s.get("section"),
-            "roll": roll_value,
-            "photo_url": s.get("photo_url", ""),
-            "session": s.get("session"),
-            "eligible": access.get("eligible", False),
-            "release_rollno": access.get("release_rollno", False),
-            "release_result": access.get("release_result", False)
-        })
-    return jsonify({"success": True, "students": students})
+    if sessions:
+        students = list(students_col.find({"session": {"$in": sessions}, "class_name": class_name}, ROSTER_FIELDS))
+    if not students:
+        students = list(students_col.find({"class_name": class_name}, ROSTER_FIELDS))
+
+    rows = []
+    for s in students:
+        row = dict(s)
+        row["student_id"] = str(s.get("_id"))
+        row["roll_key"] = roll_sort_key(s.get("rollno"))
+        rows.append(row)
+    rows.sort(key=lambda r: r["roll_key"])
+
+    roster = tuple(rows)
+    roster_cache.set(key, roster)
+    return roster
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify({
+        "success": True,
+        "caches": {name: cache.stats() for name, cache in CACHE_REGISTRY.items()}
+    })
 
 @app.route("/student-access/list", methods=["GET"])
 def student_access_list():
@@ -1080,17 +1920,10 @@ def student_access_list():
     if not session or not class_name:
         return jsonify({"success": False, "message": "Missing parameters", "students": []}), 400
 
-    sessions = session_variants(session)
-
-    students = list(students_col.find({
-        "session": {"$in": sessions},
-        "class_name": class_name
-    }))
-    if not students:
-        students = list(students_col.find({"class_name": class_name}))
+    students = get_class_roster(session, class_name)
 
     setting_docs = list(student_access_col.find({
-        "session": {"$in": sessions},
+        **session_key_filter(session),
         "class_name": class_name
     }))
     setting_map = {}
@@ -1099,24 +1932,10 @@ def student_access_list():
         if sid and sid not in setting_map:
             setting_map[sid] = doc
 
-    def roll_num(s):
-        try:
-            return int(str(s.get("rollno", "")).strip())
-        except Exception:
-            return 10**9
-
-    students.sort(key=roll_num)
     out = []
     for s in students:
-        sid = str(s.get("_id"))
-        setting = setting_map.get(sid, {})
-
-        eligible = to_bool(setting.get("eligible"), False)
-        release_rollno = to_bool(setting.get("release_rollno"), False)
-        release_result = to_bool(setting.get("release_result"), False)
-        if not eligible:
-            release_rollno = False
-            release_result = False
+        sid = s["student_id"]
+        access = access_flags_from_doc(setting_map.get(sid))
 
         out.append({
             "student_id": sid,
@@ -1124,9 +1943,9 @@ def student_access_list():
             "father_name": s.get("father_name", ""),
             "class_name": s.get("class_name", ""),
             "rollno": s.get("rollno", ""),
-            "eligible": eligible,
-            "release_rollno": release_rollno,
-            "release_result": release_result
+            "eligible": access["eligible"],
+            "release_rollno": access["release_rollno"],
+            "release_result": access["release_result"]
         })
 
     return jsonify({"success": True, "students": out})
@@ -1141,39 +1960,85 @@ def student_access_save():
     if not session or not class_name or not isinstance(students, list):
         return jsonify({"success": False, "message": "Missing data"}), 400
 
-    sessions = session_variants(session)
-    saved = 0
+    session_key = canonical_session(session)
+    wanted = {}
     for row in students:
         sid = str(row.get("student_id", "")).strip()
         if not sid:
             continue
+        wanted[sid] = access_flags_from_doc(row)
 
-        eligible = to_bool(row.get("eligible"), False)
-        release_rollno = to_bool(row.get("release_rollno"), False)
-        release_result = to_bool(row.get("release_result"), False)
-        if not eligible:
-            release_rollno = False
-            release_result = False
-
-        for sess in sessions:
-            student_access_col.update_one(
-                {"session": sess, "class_name": class_name, "student_id": sid},
-                {"$set": {
-                    "eligible": eligible,
-                    "release_rollno": release_rollno,
-                    "release_result": release_result,
-                    "updated_at": datetime.utcnow()
-                }},
-                upsert=True
-            )
-        saved += 1
+    existing = {}
+    if wanted:
+        for doc in student_access_col.find(
+            {**session_key_filter(session_key), "class_name": class_name, "student_id": {"$in": list(wanted)}},
+            {"student_id": 1, "eligible": 1, "release_rollno": 1, "release_result": 1}
+        ):
+            existing[doc.get("student_id")] = access_flags_from_doc(doc)
 
-    return jsonify({"success": True, "message": "Student access settings saved", "saved": saved})
+    now = datetime.utcnow()
+    ops = []
+    op_ids = []
+    for sid, flags in wanted.items():
+        if existing.get(sid) == flags:
+            continue
+        ops.append(UpdateOne(
+            {**session_key_filter(session_key), "class_name": class_name, "student_id": sid},
+            {"$set": {**flags, "session_key": session_key, "updated_at": now}, "$setOnInsert": {"session": session}},
+            upsert=True
+        ))
+        op_ids.append(sid)
 
+    matched = modified = upserted = 0
+    if ops:
+        try:
+            result = student_access_col.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            write_errors = (e.details or {}).get("writeErrors", [])
+            return jsonify({
+                "success": False,
+                "message": "Some student access settings could not be saved",
+                "saved": len(wanted) - len(write_errors),
+                "errors": [
+                    {"student_id": op_ids[err.get("index", 0)], "message": err.get("errmsg", "Write failed")}
+                    for err in write_errors
+                ]
+            }), 500
+        matched = result.matched_count
+        modified = result.modified_count
+        upserted = result.upserted_count
 
+    return jsonify({
+        "success": True,
+        "message": "Student access settings saved",
+        "saved": len(wanted),
+        "skipped": len(wanted) - len(ops),
+        "matched": matched,
+        "modified": modified,
+        "upserted": upserted
+    })
+
+
+# Bit positions in certificate_permissions.mask follow this order; only append new types.
 CERTIFICATE_TYPES = ["bonafide", "character", "study", "tc"]
 
 
+def certificate_permissions_mask(permissions):
+    mask = 0
+    for idx, cert_type in enumerate(CERTIFICATE_TYPES):
+        if permissions.get(cert_type):
+            mask |= 1 << idx
+    return mask
+
+
+def certificate_permissions_from_doc(doc):
+    if doc and doc.get("mask") is not None:
+        mask = int(doc.get("mask") or 0)
+        return {cert_type: bool(mask & (1 << idx)) for idx, cert_type in enumerate(CERTIFICATE_TYPES)}
+    stored = (doc or {}).get("permissions") or {}
+    return {cert_type: to_bool(stored.get(cert_type), False) for cert_type in CERTIFICATE_TYPES}
+
+
 def certificate_permission_key(value):
     text = clean_text(value).lower()
     aliases = {
@@ -1187,35 +2052,81 @@ def certificate_permission_key(value):
     return aliases.get(text, text)
 
 
-def find_student_for_certificate_permission(session, class_name, student_id="", admission_no=""):
-    sessions = session_variants(session)
-    query = {}
-    if sessions:
-        query["session"] = {"$in": sessions}
-    if class_name:
-        query["class_name"] = class_name
+CERTIFICATE_FOLD_MARKER = "certificate_access_folded"
+certificate_fold_cache = TTLCache("certificate_fold_marker", ttl_seconds=300, max_entries=1)
+
+
+def certificate_legacy_fallback_enabled():
+    # Off once migrate-certificate-access has recorded its marker doc.
+    enabled = certificate_fold_cache.get(CERTIFICATE_FOLD_MARKER)
+    if enabled is None:
+        enabled = migrations_col.find_one({"_id": CERTIFICATE_FOLD_MARKER}, {"_id": 1}) is None
+        certificate_fold_cache.set(CERTIFICATE_FOLD_MARKER, enabled)
+    return enabled
+
+
+def legacy_certificate_permissions(session, class_name, student_ids):
+    # Per-type grants in certificate_access that have not been folded into
+    # certificate_permissions yet (`flask --app app migrate-certificate-access`).
+    stored = {}
+    if not student_ids or not certificate_legacy_fallback_enabled():
+        return stored
+    for doc in certificate_access_col.find(
+        {"session": {"$in": session_variants(session)}, "class_name": class_name, "student_id": {"$in": list(student_ids)}},
+        {"student_id": 1, "certificate_type": 1, "allowed": 1}
+    ):
+        cert_type = certificate_permission_key(doc.get("certificate_type"))
+        if cert_type in CERTIFICATE_TYPES:
+            stored.setdefault(doc.get("student_id"), {})[cert_type] = to_bool(doc.get("allowed"), False)
+    return {
+        sid: {cert_type: allowed.get(cert_type, False) for cert_type in CERTIFICATE_TYPES}
+        for sid, allowed in stored.items()
+    }
 
-    if student_id:
-        try:
-            student = students_col.find_one({"_id": ObjectId(student_id)})
-            if student:
-                return student
-        except Exception:
-            pass
 
-    if admission_no:
-        variants = [admission_no, str(admission_no).strip()]
-        try:
-            variants.append(int(str(admission_no).strip()))
-        except Exception:
-            pass
-        student = students_col.find_one({**query, "admission_no": {"$in": variants}})
-        if student:
-            return student
-        student = students_col.find_one({"admission_no": {"$in": variants}})
+CERTIFICATE_STUDENT_FIELDS = {"session": 1, "class_name": 1, "admission_no": 1}
+certificate_student_cache = TTLCache(
+    "certificate_student_lookup",
+    ttl_seconds=int(os.environ.get("STUDENT_LOOKUP_CACHE_TTL_SEC", "300")),
+    max_entries=int(os.environ.get("STUDENT_LOOKUP_CACHE_MAX_ENTRIES", "4096"))
+)
+
+
+def find_student_for_certificate_permission(session, class_name, student_id="", admission_no=""):
+    # Student docs change rarely, so both the _id lookup and the
+    # admission_no -> students index are served from memory when warm.
+    if student_id and ObjectId.is_valid(student_id):
+        cache_key = ("id", student_id)
+        student = certificate_student_cache.get(cache_key)
+        if student is None:
+            student = students_col.find_one({"_id": ObjectId(student_id)}, CERTIFICATE_STUDENT_FIELDS)
+            if student:
+                certificate_student_cache.set(cache_key, student)
         if student:
             return student
 
+    admission_key = clean_text(admission_no)
+    if admission_key:
+        cache_key = ("admission_no", admission_key)
+        candidates = certificate_student_cache.get(cache_key)
+        if candidates is None:
+            variants = [admission_no, admission_key]
+            try:
+                variants.append(int(admission_key))
+            except Exception:
+                pass
+            candidates = tuple(students_col.find({"admission_no": {"$in": variants}}, CERTIFICATE_STUDENT_FIELDS))
+            if candidates:
+                certificate_student_cache.set(cache_key, candidates)
+
+        # Prefer the student in the requested session/class, like the old filtered lookup.
+        sessions = set(session_variants(session))
+        for student in candidates:
+            if (not sessions or student.get("session") in sessions) and (not class_name or student.get("class_name") == class_name):
+                return student
+        if candidates:
+            return candidates[0]
+
     return None
 
 
@@ -1226,31 +2137,27 @@ def certificate_access_list():
     if not session or not class_name:
         return jsonify({"success": False, "message": "Missing parameters", "students": []}), 400
 
-    sessions = session_variants(session)
-    students = list(students_col.find({"session": {"$in": sessions}, "class_name": class_name}))
-    if not students:
-        students = list(students_col.find({"class_name": class_name}))
+    students = get_class_roster(session, class_name)
 
-    docs = list(certificate_access_col.find({"session": {"$in": sessions}, "class_name": class_name}))
     access_map = {}
-    for doc in docs:
-        key = (doc.get("student_id"), doc.get("certificate_type"))
-        if key not in access_map:
-            access_map[key] = doc
-
-    def roll_num(s):
-        try:
-            return int(str(s.get("rollno", "")).strip())
-        except Exception:
-            return 10**9
+    for doc in certificate_permissions_col.find(
+        {**session_key_filter(session), "class_name": class_name},
+        {"student_id": 1, "mask": 1, "permissions": 1}
+    ):
+        sid = doc.get("student_id")
+        if sid and sid not in access_map:
+            access_map[sid] = doc
+    legacy_map = legacy_certificate_permissions(
+        session, class_name, [s["student_id"] for s in students if s["student_id"] not in access_map]
+    )
 
     out = []
-    for student in sorted(students, key=roll_num):
-        sid = str(student.get("_id"))
-        permissions = {}
-        for cert_type in CERTIFICATE_TYPES:
-            doc = access_map.get((sid, cert_type), {})
-            permissions[cert_type] = to_bool(doc.get("allowed"), False)
+    for student in students:
+        sid = student["student_id"]
+        if sid in access_map:
+            permissions = certificate_permissions_from_doc(access_map[sid])
+        else:
+            permissions = legacy_map.get(sid) or certificate_permissions_from_doc(None)
 
         out.append({
             "student_id": sid,
@@ -1275,7 +2182,10 @@ def certificate_access_save():
     if not session or not class_name or not isinstance(students, list):
         return jsonify({"success": False, "message": "Missing data"}), 400
 
-    sessions = session_variants(session)
+    session_key = canonical_session(session)
+    now = datetime.utcnow()
+    ops = []
+    op_ids = []
     saved = 0
     for row in students:
         sid = clean_text(row.get("student_id"))
@@ -1283,25 +2193,37 @@ def certificate_access_save():
         if not sid:
             continue
 
-        for cert_type in CERTIFICATE_TYPES:
-            allowed = to_bool(permissions.get(cert_type), False)
-            for sess in sessions:
-                certificate_access_col.update_one(
-                    {
-                        "session": sess,
-                        "class_name": class_name,
-                        "student_id": sid,
-                        "certificate_type": cert_type,
-                    },
-                    {
-                        "$set": {
-                            "allowed": allowed,
-                            "updated_at": datetime.utcnow(),
-                        }
-                    },
-                    upsert=True,
-                )
-            saved += 1
+        allowed = {cert_type: to_bool(permissions.get(cert_type), False) for cert_type in CERTIFICATE_TYPES}
+        ops.append(UpdateOne(
+            {**session_key_filter(session_key), "class_name": class_name, "student_id": sid},
+            {
+                "$set": {
+                    "session_key": session_key,
+                    "permissions": allowed,
+                    "mask": certificate_permissions_mask(allowed),
+                    "updated_at": now,
+                },
+                "$setOnInsert": {"session": session},
+            },
+            upsert=True,
+        ))
+        op_ids.append(sid)
+        saved += len(CERTIFICATE_TYPES)
+
+    if ops:
+        try:
+            certificate_permissions_col.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            write_errors = (e.details or {}).get("writeErrors", [])
+            return jsonify({
+                "success": False,
+                "message": "Some certificate permissions could not be saved",
+                "saved": saved - len(write_errors) * len(CERTIFICATE_TYPES),
+                "errors": [
+                    {"student_id": op_ids[err.get("index", 0)], "message": err.get("errmsg", "Write failed")}
+                    for err in write_errors
+                ]
+            }), 500
 
     return jsonify({"success": True, "message": "Certificate permissions saved", "saved": saved})
 
@@ -1321,22 +2243,114 @@ def certificate_access_check():
         return jsonify({"success": True, "allowed": False, "reason": "student_not_found"})
 
     sid = str(student.get("_id"))
-    sessions = session_variants(session or student.get("session", ""))
-    doc = certificate_access_col.find_one({
-        "session": {"$in": sessions},
+    doc = certificate_permissions_col.find_one({
+        **session_key_filter(session or student.get("session", "")),
         "class_name": class_name or student.get("class_name", ""),
         "student_id": sid,
-        "certificate_type": cert_type,
-    })
+    }, {"mask": 1, "permissions": 1})
+    if doc:
+        permissions = certificate_permissions_from_doc(doc)
+    else:
+        permissions = legacy_certificate_permissions(
+            session or student.get("session", ""), class_name or student.get("class_name", ""), [sid]
+        ).get(sid) or certificate_permissions_from_doc(None)
+    allowed = permissions[cert_type]
 
     return jsonify({
         "success": True,
-        "allowed": to_bool(doc.get("allowed"), False) if doc else False,
-        "reason": "allowed" if doc and to_bool(doc.get("allowed"), False) else "permission_required",
+        "allowed": allowed,
+        "reason": "allowed" if allowed else "permission_required",
         "student_id": sid,
         "certificate_type": cert_type,
     })
 
+@app.cli.command("migrate-certificate-access")
+def migrate_certificate_access():
+    """Fold legacy per-type certificate_access docs into certificate_permissions.
+
+    Run with: flask --app app migrate-certificate-access
+    Students that already have a compact document are left untouched. Until
+    this runs, list/check fall back to certificate_access for such students;
+    it then records a marker in `migrations` that switches the fallback off.
+    """
+    grouped = {}
+    for doc in certificate_access_col.find({}, {"session": 1, "class_name": 1, "student_id": 1, "certificate_type": 1, "allowed": 1}):
+        cert_type = certificate_permission_key(doc.get("certificate_type"))
+        if cert_type not in CERTIFICATE_TYPES or not doc.get("student_id"):
+            continue
+        key = (canonical_session(doc.get("session", "")), doc.get("class_name", ""), doc.get("student_id"))
+        grouped.setdefault(key, {})[cert_type] = to_bool(doc.get("allowed"), False)
+
+    now = datetime.utcnow()
+    ops = []
+    for (session_key, class_name, sid), stored in grouped.items():
+        allowed = {cert_type: stored.get(cert_type, False) for cert_type in CERTIFICATE_TYPES}
+        ops.append(UpdateOne(
+            {"session_key": session_key, "class_name": class_name, "student_id": sid},
+            {"$setOnInsert": {
+                "session": session_key,
+                "permissions": allowed,
+                "mask": certificate_permissions_mask(allowed),
+                "updated_at": now,
+            }},
+            upsert=True,
+        ))
+
+    upserted = 0
+    for i in range(0, len(ops), 1000):
+        upserted += certificate_permissions_col.bulk_write(ops[i:i + 1000], ordered=False).upserted_count
+    migrations_col.replace_one(
+        {"_id": CERTIFICATE_FOLD_MARKER},
+        {"done_at": now, "students": len(grouped)},
+        upsert=True
+    )
+    certificate_fold_cache.clear()
+    print(f"Folded {len(grouped)} students from certificate_access; {upserted} new certificate_permissions docs")
+
+def merge_session_key_duplicates(col, key_fields):
+    # Collapse docs whose raw sessions differ only by spelling onto one doc per
+    # canonical key (newest wins) and backfill session_key on the survivor.
+    projection = {"session": 1, "session_key": 1, "updated_at": 1}
+    projection.update({field: 1 for field in key_fields})
+    groups = {}
+    for doc in col.find({}, projection):
+        key = (canonical_session(doc.get("session", "")),) + tuple(doc.get(field) for field in key_fields)
+        groups.setdefault(key, []).append(doc)
+
+    ops = []
+    removed = 0
+    for key, docs in groups.items():
+        docs.sort(key=lambda d: (d.get("updated_at") or datetime.min, d["_id"]), reverse=True)
+        keep, extras = docs[0], docs[1:]
+        if extras:
+            ops.append(DeleteMany({"_id": {"$in": [d["_id"] for d in extras]}}))
+            removed += len(extras)
+        if keep.get("session_key") != key[0]:
+            ops.append(UpdateOne({"_id": keep["_id"]}, {"$set": {"session_key": key[0]}}))
+
+    # Deletes run before the backfill so the partial unique index never sees two keyed docs.
+    ops.sort(key=lambda op: 0 if isinstance(op, DeleteMany) else 1)
+    for i in range(0, len(ops), 1000):
+        col.bulk_write(ops[i:i + 1000], ordered=True)
+    return len(groups), removed
+
+
+@app.cli.command("migrate-session-keys")
+def migrate_session_keys():
+    """Backfill session_key and merge "2025-26"/"2025_26" duplicate docs.
+
+    Run with: flask --app app migrate-session-keys
+    Until it runs, session_key_filter() keeps unkeyed docs readable.
+    """
+    targets = [
+        (student_access_col, ["class_name", "student_id"]),
+        (certificate_permissions_col, ["class_name", "student_id"]),
+        (attendance_col, ["class_name", "date", "student_id"]),
+    ]
+    for col, key_fields in targets:
+        kept, removed = merge_session_key_duplicates(col, key_fields)
+        print(f"{col.name}: {kept} docs keyed, {removed} duplicates removed")
+
 # ---------------------------
 # debug datesheet (show collection's keys info)
 # ---------------------------
@@ -1458,25 +2472,87 @@ def add_marks():
         return jsonify({"success": False, "message": "Missing data"}), 400
 
     # find exam id (we store as ObjectId)
-    exam_doc = exams_col.find_one({"exam_name": exam_name, "session": session})
+    exam_doc = get_exam_doc(session, exam_name, fresh=True)
     if not exam_doc:
         return jsonify({"success": False, "message": "Exam not found"}), 404
     exam_id = exam_doc.get("_id")
 
-    # upsert each mark
-    for item in marks_list:
+    # validate + coerce every row first, then upsert the sheet in one round trip
+    rows = {}
+    errors = []
+    skipped = 0
+    for idx, item in enumerate(marks_list):
+        if not isinstance(item, dict):
+            errors.append({"index": idx, "message": "Invalid row"})
+            continue
         roll = item.get("roll")
         subject = item.get("subject")
         marks_value = item.get("marks")
         if roll is None or subject is None or marks_value is None:
+            skipped += 1
+            continue
+        try:
+            marks_int = int(marks_value)
+        except (TypeError, ValueError):
+            errors.append({"index": idx, "roll": roll, "subject": subject, "message": f"Invalid marks: {marks_value}"})
             continue
-        exam_marks_col.update_one(
+        # later rows for the same roll+subject win, as with sequential upserts
+        rows[(subject, roll)] = marks_int
+
+    if not rows:
+        if errors:
+            return jsonify({
+                "success": False,
+                "message": "No valid marks rows",
+                "errors": errors,
+                "skipped": skipped
+            }), 400
+        # A sheet saved with every mark still blank is a no-op, not an error.
+        return jsonify({
+            "success": True,
+            "message": "Marks added/updated successfully",
+            "saved": 0,
+            "matched": 0,
+            "modified": 0,
+            "upserted": 0,
+            "errors": errors,
+            "skipped": skipped
+        })
+
+    keys = list(rows)
+    ops = [
+        UpdateOne(
             {"session": session, "exam_id": exam_id, "class_name": class_name, "subject": subject, "roll": roll},
-            {"$set": {"marks": int(marks_value)}},
+            {"$set": {"marks": rows[(subject, roll)]}},
             upsert=True
         )
+        for subject, roll in keys
+    ]
+    try:
+        result = exam_marks_col.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        details = e.details or {}
+        for err in details.get("writeErrors", []):
+            subject, roll = keys[err.get("index", 0)]
+            errors.append({"roll": roll, "subject": subject, "message": err.get("errmsg", "Write failed")})
+        return jsonify({
+            "success": False,
+            "message": "Some marks could not be saved",
+            "saved": len(rows) - len(details.get("writeErrors", [])),
+            "errors": errors,
+            "skipped": skipped
+        }), 500
 
-    return jsonify({"success": True, "message": "Marks added/updated successfully"})
+    return jsonify({
+        "success": True,
+        "message": "Marks added/updated successfully",
+        "saved": len(rows),
+        "matched": result.matched_count,
+        "modified": result.modified_count,
+        "upserted": result.upserted_count,
+        "errors": errors,
+        "skipped": skipped
+    })
 
 # ---------------------------
 # Get marks
@@ -1487,24 +2563,125 @@ def get_marks():
     class_name = request.args.get("class_name")
     exam_name = request.args.get("exam_name")
 
-    if not session or not class_name or not exam_name:
+    if not session or not class_name or not exam_name:
+        return jsonify({"success": False, "message": "Missing parameters"}), 400
+
+    exam_doc = get_exam_doc(session, exam_name)
+    if not exam_doc:
+        return jsonify({"success": False, "message": "Exam not found"}), 404
+    exam_id = exam_doc.get("_id")
+
+    cursor = exam_marks_col.find({"session": session, "class_name": class_name, "exam_id": exam_id})
+    marks = []
+    for row in cursor:
+        marks.append({
+            "student_id": row.get("roll"),
+            "roll": row.get("roll"),
+            "subject": row.get("subject"),
+            "marks": row.get("marks")
+        })
+    return jsonify({"success": True, "marks": marks})
+
+# ---------------------------
+# Export marks sheets as XLSX (streamed, one sheet per class)
+# ---------------------------
+@app.route("/exam/export-marks.xlsx", methods=["GET"])
+def export_marks_xlsx():
+    session = request.args.get("session")
+    exam_name = request.args.get("exam_name")
+    class_name = request.args.get("class_name")
+
+    if not session or not exam_name:
         return jsonify({"success": False, "message": "Missing parameters"}), 400
 
-    exam_doc = exams_col.find_one({"exam_name": exam_name, "session": session})
+    exam_doc = get_exam_doc(session, exam_name)
     if not exam_doc:
         return jsonify({"success": False, "message": "Exam not found"}), 404
     exam_id = exam_doc.get("_id")
 
-    cursor = exam_marks_col.find({"session": session, "class_name": class_name, "exam_id": exam_id})
-    marks = []
-    for row in cursor:
-        marks.append({
-            "student_id": row.get("roll"),
-            "roll": row.get("roll"),
-            "subject": row.get("subject"),
-            "marks": row.get("marks")
-        })
-    return jsonify({"success": True, "marks": marks})
+    external_filter = {"session": session, "exam_id": exam_id}
+    internal_filter = {"session": session, "exam_name": exam_name}
+    if class_name:
+        classes = [class_name]
+    else:
+        classes = set(exam_marks_col.distinct("class_name", external_filter))
+        classes.update(internal_marks_col.distinct("class_name", internal_filter))
+        classes = sorted([c for c in classes if c], key=class_sort_key)
+    if not classes:
+        return jsonify({"success": False, "message": "No marks found"}), 404
+
+    wb = Workbook(write_only=True)
+    for cls in classes:
+        cls_external = {**external_filter, "class_name": cls}
+        cls_internal = {**internal_filter, "class_name": cls}
+
+        subjects = [r.get("subject") for r in exam_subjects_col.find({"session": session, "class_name": cls}, {"subject": 1})]
+        for sub in exam_marks_col.distinct("subject", cls_external) + internal_marks_col.distinct("subject", cls_internal):
+            if sub not in subjects:
+                subjects.append(sub)
+        subjects = [sub for sub in subjects if sub]
+
+        # One class's marks are small enough to buffer, so rows can follow the
+        # roster's numeric roll order rather than the lexical order of exam_marks.roll.
+        roster = get_class_roster(session, cls)
+        external = {}
+        for row in exam_marks_col.find(cls_external, {"roll": 1, "subject": 1, "marks": 1}):
+            external.setdefault(str(row.get("roll")), {})[row.get("subject")] = row.get("marks")
+        internal = {}
+        for row in internal_marks_col.find(cls_internal, {"student_id": 1, "student_name": 1, "subject": 1, "marks": 1}):
+            entry = internal.setdefault(str(row.get("student_id")), {"name": row.get("student_name", ""), "marks": {}})
+            entry["marks"][row.get("subject")] = row.get("marks")
+
+        ws = wb.create_sheet(title=re.sub(r"[\[\]:*?/\\]", "-", str(cls))[:31])
+        header = ["Roll", "Student"]
+        for sub in subjects:
+            header.extend([f"{sub} (Ext)", f"{sub} (Int)"])
+        header.append("Total")
+        ws.append(header)
+
+        def sheet_row(roll, name, ext_marks, int_marks):
+            values = [roll, name]
+            total = 0
+            for sub in subjects:
+                ext = ext_marks.get(sub)
+                inn = int_marks.get(sub)
+                values.extend([ext, inn])
+                for v in (ext, inn):
+                    num = _marks_number(v)
+                    if num is not None:
+                        total += num
+            values.append(total)
+            return values
+
+        # exam_marks.roll holds either the student id or the roll number
+        for st in roster:
+            sid = st["student_id"]
+            ext_marks = external.pop(sid, None)
+            if ext_marks is None:
+                ext_marks = external.pop(str(st.get("rollno", "")), None)
+            int_entry = internal.pop(sid, None)
+            if ext_marks is None and int_entry is None:
+                continue
+            int_entry = int_entry or {"name": "", "marks": {}}
+            name = st.get("student_name", "") or st.get("name", "") or int_entry["name"]
+            ws.append(sheet_row(st.get("rollno", ""), name, ext_marks or {}, int_entry["marks"]))
+
+        # marks that match no roster student
+        for roll in sorted(external, key=lambda r: (roll_sort_key(r), r)):
+            ws.append(sheet_row(roll, "", external[roll], {}))
+        for entry in internal.values():
+            ws.append(sheet_row("", entry["name"], {}, entry["marks"]))
+
+    output = tempfile.TemporaryFile()
+    wb.save(output)
+    output.seek(0)
+    filename = f"marks_{session}_{exam_name}" + (f"_{class_name}" if class_name else "") + ".xlsx"
+    return send_file(
+        output,
+        as_attachment=True,
+        download_name=re.sub(r"[^A-Za-z0-9_.-]+", "_", filename),
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
 
 # ---------------------------
 # Save internal marks (upsert)
@@ -1522,40 +2699,108 @@ def save_internal_marks():
     if not session or not class_name or not subject or not exam_name or not marks_list:
         return jsonify({"success": False, "message": "Missing data"}), 400
 
+    sheet_filter = {
+        "session": session,
+        "class_name": class_name,
+        "subject": subject,
+        "exam_name": exam_name
+    }
+
+    outcomes = []
+    rows = {}
+    for idx, item in enumerate(marks_list):
+        item = item if isinstance(item, dict) else {}
+        student_id = item.get("student_id")
+        student_name = item.get("student_name")
+        marks_value = item.get("marks")
+        if not student_id or not student_name or marks_value is None:
+            outcomes.append({"index": idx, "student_id": student_id, "status": "skipped"})
+            continue
+        try:
+            marks_int = int(marks_value)
+        except (TypeError, ValueError):
+            outcomes.append({"index": idx, "student_id": student_id, "status": "error", "message": f"Invalid marks: {marks_value}"})
+            continue
+        # Last row for a student wins; earlier ones still get an outcome.
+        if student_id in rows:
+            outcomes.append({
+                "index": rows[student_id][0],
+                "student_id": student_id,
+                "status": "duplicate",
+                "message": f"Superseded by row {idx}"
+            })
+        rows[student_id] = (idx, student_name, marks_int)
+
     try:
-        for item in marks_list:
-            student_id = item.get("student_id")
-            student_name = item.get("student_name")
-            marks_value = item.get("marks")
-            if not student_id or not student_name or marks_value is None:
+        existing = {}
+        if rows:
+            for doc in internal_marks_col.find(
+                {**sheet_filter, "student_id": {"$in": list(rows)}},
+                {"student_id": 1, "marks": 1, "teacher_id": 1}
+            ):
+                existing[doc.get("student_id")] = doc
+
+        now = datetime.utcnow()
+        ops = []
+        op_rows = []
+        for student_id, (idx, student_name, marks_int) in rows.items():
+            prev = existing.get(student_id)
+            if prev and prev.get("marks") == marks_int and prev.get("teacher_id", "") == teacher_id:
+                outcomes.append({"index": idx, "student_id": student_id, "status": "unchanged"})
                 continue
-
-            internal_marks_col.update_one(
-                {
-                    "session": session,
-                    "class_name": class_name,
-                    "subject": subject,
-                    "exam_name": exam_name,
-                    "student_id": student_id
-                },
+            ops.append(UpdateOne(
+                {**sheet_filter, "student_id": student_id},
                 {
                     "$set": {
                         "student_name": student_name,
-                        "marks": int(marks_value),
+                        "marks": marks_int,
                         "teacher_id": teacher_id,
                         "exam_name": exam_name,
-                        "updated_at": datetime.utcnow()
+                        "updated_at": now
                     }
                 },
                 upsert=True
-            )
+            ))
+            op_rows.append((idx, student_id, "updated" if prev else "inserted"))
+
+        failed = {}
+        if ops:
+            try:
+                internal_marks_col.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                for err in (e.details or {}).get("writeErrors", []):
+                    failed[err.get("index")] = err.get("errmsg", "Write failed")
     except Exception as e:
         return jsonify({
             "success": False,
             "message": f"Failed to save internal marks: {str(e)}"
         }), 500
 
-    return jsonify({"success": True, "message": "Internal marks saved successfully"})
+    for op_idx, (idx, student_id, status) in enumerate(op_rows):
+        if op_idx in failed:
+            outcomes.append({"index": idx, "student_id": student_id, "status": "error", "message": failed[op_idx]})
+        else:
+            outcomes.append({"index": idx, "student_id": student_id, "status": status})
+    outcomes.sort(key=lambda o: o["index"])
+
+    counts = {}
+    for o in outcomes:
+        counts[o["status"]] = counts.get(o["status"], 0) + 1
+
+    if failed:
+        return jsonify({
+            "success": False,
+            "message": "Some internal marks could not be saved",
+            "counts": counts,
+            "rows": outcomes
+        }), 500
+
+    return jsonify({
+        "success": True,
+        "message": "Internal marks saved successfully",
+        "counts": counts,
+        "rows": outcomes
+    })
 
 # ---------------------------
 # Get internal marks
@@ -1614,6 +2859,33 @@ def list_internal_subjects():
 # ---------------------------
 # Publish/Unpublish Results
 # ---------------------------
+def build_result_snapshots(session, class_name, exam_name, exam_doc):
+    computed = compute_class_result(session, class_name, exam_name, exam_doc)
+    session_key = canonical_session(session)
+    generated_at = datetime.utcnow()
+    class_filter = {"session_key": session_key, "class_name": class_name, "exam_name": exam_name}
+    ops = []
+    for row in computed["students"]:
+        ops.append(UpdateOne(
+            {**class_filter, "student_key": row["student_id"]},
+            {"$set": {
+                "session": session,
+                "subject_order": computed["subjects"],
+                "max_marks": computed["max_marks"],
+                "generated_at": generated_at,
+                **row
+            }},
+            upsert=True
+        ))
+
+    # New generation first, then drop older ones: a re-publish never leaves a
+    # window where published students have no snapshot, and a failed write
+    # keeps the previous set.
+    for i in range(0, len(ops), 1000):
+        result_snapshots_col.bulk_write(ops[i:i + 1000], ordered=False)
+    result_snapshots_col.delete_many({**class_filter, "generated_at": {"$lt": generated_at}})
+    return len(ops)
+
 @app.route("/result/publish", methods=["POST"])
 def publish_result():
     data = request.get_json() or {}
@@ -1629,12 +2901,24 @@ def publish_result():
         published = published.strip().lower() in ["1", "true", "yes"]
     published = bool(published)
 
+    snapshot_filter = {"session_key": canonical_session(session), "class_name": class_name, "exam_name": exam_name}
+    snapshots = 0
+    if published:
+        # Build the immutable per-student results before the flag flips, so a
+        # published result always has its snapshot.
+        exam_doc = get_exam_doc(session, exam_name, fresh=True)
+        if not exam_doc:
+            return jsonify({"success": False, "message": "Exam not found"}), 404
+        snapshots = build_result_snapshots(session, class_name, exam_name, exam_doc)
+    else:
+        result_snapshots_col.delete_many(snapshot_filter)
+
     result_publish_col.update_one(
         {"session": session, "class_name": class_name, "exam_name": exam_name},
         {"$set": {"published": published, "updated_at": datetime.utcnow()}},
         upsert=True
     )
-    return jsonify({"success": True, "published": published})
+    return jsonify({"success": True, "published": published, "snapshots": snapshots})
 
 @app.route("/result/status", methods=["GET"])
 def result_status():
@@ -1653,6 +2937,34 @@ def result_status():
     published = bool(doc.get("published")) if doc else False
     return jsonify({"success": True, "published": published})
 
+@app.route("/result/student", methods=["GET"])
+def get_student_result():
+    session = request.args.get("session")
+    class_name = request.args.get("class_name")
+    exam_name = request.args.get("exam_name")
+    student_id = clean_text(request.args.get("student_id"))
+
+    if not session or not class_name or not exam_name or not student_id:
+        return jsonify({"success": False, "message": "Missing parameters"}), 400
+
+    # Class-level publish is not enough; the student's own release flag must be on too.
+    access = get_student_access_flags({"_id": student_id, "session": session, "class_name": class_name})
+    if not access["release_result"]:
+        return jsonify({"success": False, "message": "Result not released for this student"}), 403
+
+    doc = result_snapshots_col.find_one({
+        "session_key": canonical_session(session),
+        "class_name": class_name,
+        "exam_name": exam_name,
+        "student_key": student_id
+    }, {"_id": 0, "session_key": 0, "student_key": 0})
+    if not doc:
+        return jsonify({"success": False, "message": "Result not published"}), 404
+
+    generated_at = doc.get("generated_at")
+    doc["generated_at"] = generated_at.isoformat() if isinstance(generated_at, datetime) else ""
+    return jsonify({"success": True, "result": doc})
+
 # ---------------------------
 # Save internal marks config (max/weightage) per subject
 # ---------------------------
@@ -1787,7 +3099,7 @@ def get_exam_subject_config():
     })
 
     # Fallbacks for backward compatibility
-    exam_doc = exams_col.find_one({"session": session, "exam_name": exam_name}) or {}
+    exam_doc = get_exam_doc(session, exam_name) or {}
     internal_doc = internal_config_col.find_one({
         "session": session,
         "class_name": class_name,
@@ -1808,6 +3120,153 @@ def get_exam_subject_config():
             "internal_max_marks": (doc.get("internal_max_marks") if doc else internal_fallback)
         }
     })
+
+# ---------------------------
+# Server-side result computation (external + internal marks)
+# ---------------------------
+def _marks_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def compute_class_result(session, class_name, exam_name, exam_doc):
+    # One query per source collection, joined in memory; replaces the
+    # per-subject calls the frontend used to make for every class.
+    exam_id = exam_doc.get("_id")
+    roster = get_class_roster(session, class_name)
+
+    subjects = [r.get("subject") for r in exam_subjects_col.find(
+        {"session": session, "class_name": class_name}, {"subject": 1}
+    ) if r.get("subject")]
+
+    external = {}
+    for row in exam_marks_col.find(
+        {"session": session, "class_name": class_name, "exam_id": exam_id},
+        {"roll": 1, "subject": 1, "marks": 1}
+    ):
+        external.setdefault(str(row.get("roll")), {})[row.get("subject")] = _marks_number(row.get("marks"))
+
+    internal = {}
+    internal_names = {}
+    for row in internal_marks_col.find(
+        {"session": session, "class_name": class_name, "exam_name": exam_name},
+        {"student_id": 1, "student_name": 1, "subject": 1, "marks": 1}
+    ):
+        sid = str(row.get("student_id"))
+        internal.setdefault(sid, {})[row.get("subject")] = _marks_number(row.get("marks"))
+        internal_names.setdefault(sid, row.get("student_name", ""))
+
+    subject_config = {
+        d.get("subject"): d for d in exam_subject_config_col.find(
+            {"session": session, "class_name": class_name, "exam_name": exam_name}
+        )
+    }
+    internal_config = {
+        d.get("subject"): d for d in internal_config_col.find({"session": session, "class_name": class_name})
+    }
+
+    # exam_marks.roll holds either the student id or the roll number. Only roster
+    # students are ranked; marks rows that match nobody are reported separately.
+    students = []
+    matched_rolls = set()
+    for st in roster:
+        sid = st["student_id"]
+        roll = str(st.get("rollno", ""))
+        roll_key = sid if sid in external else roll
+        matched_rolls.add(roll_key)
+        students.append({
+            "student_id": sid,
+            "name": st.get("student_name", "") or st.get("name", "") or internal_names.get(sid, ""),
+            "rollno": st.get("rollno", ""),
+            "ext": external.get(roll_key, {}),
+            "int": internal.get(sid, {}),
+        })
+    unmatched_rolls = sorted((r for r in external if r not in matched_rolls), key=lambda r: (roll_sort_key(r), r))
+
+    for st in students:
+        for sub in list(st["ext"]) + list(st["int"]):
+            if sub and sub not in subjects:
+                subjects.append(sub)
+
+    max_marks = {}
+    for sub in subjects:
+        cfg = subject_config.get(sub)
+        if cfg:
+            ext_max = _marks_number(cfg.get("external_max_marks"))
+            int_max = _marks_number(cfg.get("internal_max_marks"))
+        else:
+            ext_max = _marks_number(exam_doc.get("total_marks"))
+            int_max = _marks_number((internal_config.get(sub) or {}).get("max_marks"))
+        max_marks[sub] = (ext_max or 0.0, int_max or 0.0)
+
+
+    results = []
+    for st in students:
+        subject_rows = {}
+        grand_total = 0.0
+        max_total = 0.0
+        for sub in subjects:
+            ext_max, int_max = max_marks[sub]
+            ext = st["ext"].get(sub)
+            inn = st["int"].get(sub)
+            total = (ext or 0.0) + (inn or 0.0)
+            subject_rows[sub] = {
+                "external": ext,
+                "internal": inn,
+                "total": total,
+                "max_marks": ext_max + int_max
+            }
+            grand_total += total
+            max_total += ext_max + int_max
+        results.append({
+            "student_id": st["student_id"],
+            "name": st["name"],
+            "rollno": st["rollno"],
+            "subjects": subject_rows,
+            "grand_total": grand_total,
+            "max_total": max_total,
+            "percentage": round(grand_total * 100.0 / max_total, 2) if max_total else 0.0,
+        })
+
+    # competition ranking: equal totals share a rank (1, 2, 2, 4)
+    ordered = sorted(results, key=lambda r: -r["grand_total"])
+    prev_total = None
+    rank = 0
+    for pos, row in enumerate(ordered, start=1):
+        if row["grand_total"] != prev_total:
+            rank = pos
+            prev_total = row["grand_total"]
+        row["rank"] = rank
+
+    return {
+        "subjects": subjects,
+        "max_marks": {sub: {"external": m[0], "internal": m[1]} for sub, m in max_marks.items()},
+        "students": results,
+        "unmatched_rolls": unmatched_rolls
+    }
+
+@app.route("/result/compute", methods=["GET"])
+def compute_result():
+    session = request.args.get("session")
+    class_name = request.args.get("class_name")
+    exam_name = request.args.get("exam_name")
+
+    if not session or not class_name or not exam_name:
+        return jsonify({"success": False, "message": "Missing parameters"}), 400
+
+    exam_doc = get_exam_doc(session, exam_name)
+    if not exam_doc:
+        return jsonify({"success": False, "message": "Exam not found"}), 404
+
+    result = compute_class_result(session, class_name, exam_name, exam_doc)
+    return jsonify({
+        "success": True,
+        "session": session,
+        "class_name": class_name,
+        "exam_name": exam_name,
+        **result
+    })
 # PART 3/4
 # ---------------------------
 # Get exam details by session + exam name
@@ -1817,7 +3276,7 @@ def get_exam_subject_config():
 def get_exam_details(session, exam_name):
     try:
         exam_name_clean = exam_name.replace("%20", " ")
-        exam = exams_col.find_one({"session": session, "exam_name": exam_name_clean})
+        exam = get_exam_doc(session, exam_name_clean)
         if not exam:
             return jsonify({"success": False, "message": "Exam not found"}), 404
         exam_out = {
@@ -1882,6 +3341,7 @@ def add_teacher():
             "password": password,
             "name": name
         })
+        invalidate_teacher_caches()
 
         return jsonify({
             "success": True,
@@ -1930,6 +3390,7 @@ def delete_teacher(teacher_id):
         delete_filter["$or"].append({"teacher_id": obj})  # stored as ObjectId
 
     timetable_col.delete_many(delete_filter)
+    invalidate_teacher_caches()
 
     return jsonify({"success": True, "message": "Teacher and full timetable deleted"})
 
@@ -1999,6 +3460,7 @@ def update_teacher(teacher_id):
         update_doc["password"] = password
 
     teachers_col.update_one({"_id": teacher["_id"]}, {"$set": update_doc})
+    invalidate_teacher_caches()
     return jsonify({"success": True, "message": "Teacher updated"})
 
 @app.route("/teacher/reset-password/<teacher_id>", methods=["PUT"])
@@ -2049,6 +3511,17 @@ def reset_teacher_password_by_identity():
     teachers_col.update_one({"_id": teacher["_id"]}, {"$set": {"password": new_password}})
     return jsonify({"success": True, "message": "Password updated"})
 
+def otp_verify_response(status):
+    if status == "missing":
+        return jsonify({"success": False, "message": "OTP not requested"}), 400
+    if status == "expired":
+        return jsonify({"success": False, "message": "OTP expired"}), 400
+    if status == "locked":
+        return jsonify({"success": False, "message": "Too many invalid attempts"}), 429
+    if status == "invalid":
+        return jsonify({"success": False, "message": "Invalid OTP"}), 401
+    return jsonify({"success": True, "message": "OTP verified"})
+
 @app.route("/auth/otp/request", methods=["POST"])
 def request_login_otp():
     data = request.json or {}
@@ -2068,11 +3541,7 @@ def request_login_otp():
 
     otp_code = f"{random.randint(0, 999999):06d}"
     expires_at = datetime.utcnow() + timedelta(minutes=5)
-    OTP_STORE[username] = {
-        "otp": otp_code,
-        "expires_at": expires_at,
-        "attempts": 0
-    }
+    OTP_STORE.put(username, otp_code, expires_at)
 
     sent, err = send_otp_email(to_email, otp_code, username)
     if not sent:
@@ -2102,25 +3571,85 @@ def verify_login_otp():
     username = str(data.get("username", "")).strip().upper()
     otp = str(data.get("otp", "")).strip()
 
-    rec = OTP_STORE.get(username)
-    if not rec:
-        return jsonify({"success": False, "message": "OTP not requested"}), 400
+    return otp_verify_response(OTP_STORE.verify(username, otp))
 
-    if datetime.utcnow() > rec["expires_at"]:
-        OTP_STORE.pop(username, None)
-        return jsonify({"success": False, "message": "OTP expired"}), 400
+# ---------------------------
+# Teacher OTP delivery queue (SMS/email sent off the request thread)
+# ---------------------------
+OTP_DISPATCH_WORKERS = max(1, int(os.environ.get("OTP_DISPATCH_WORKERS", "4") or 4))
+OTP_DISPATCH_MAX_PENDING = max(1, int(os.environ.get("OTP_DISPATCH_MAX_PENDING", "32") or 32))
+_otp_dispatch_pool = None
+_otp_dispatch_pool_lock = threading.Lock()
+_otp_dispatch_slots = threading.BoundedSemaphore(OTP_DISPATCH_MAX_PENDING)
+
+def get_otp_dispatch_pool():
+    # Created lazily so a forked gunicorn worker never inherits dead threads.
+    global _otp_dispatch_pool
+    with _otp_dispatch_pool_lock:
+        if _otp_dispatch_pool is None:
+            _otp_dispatch_pool = ThreadPoolExecutor(
+                max_workers=OTP_DISPATCH_WORKERS,
+                thread_name_prefix="otp-dispatch"
+            )
+        return _otp_dispatch_pool
 
-    if rec.get("attempts", 0) >= 5:
-        OTP_STORE.pop(username, None)
-        return jsonify({"success": False, "message": "Too many invalid attempts"}), 429
+def set_otp_delivery_status(delivery_id, status, **fields):
+    otp_deliveries_col.update_one(
+        {"_id": delivery_id},
+        {"$set": {"status": status, "updated_at": datetime.utcnow(), **fields}}
+    )
 
-    if otp != rec.get("otp"):
-        rec["attempts"] = rec.get("attempts", 0) + 1
-        OTP_STORE[username] = rec
-        return jsonify({"success": False, "message": "Invalid OTP"}), 401
+def deliver_teacher_otp(delivery_id, username, mobile, otp_code, teacher_name):
+    try:
+        set_otp_delivery_status(delivery_id, "sending")
+        sent, err = send_textbee_otp(mobile, otp_code, teacher_name)
+        if sent:
+            set_otp_delivery_status(delivery_id, "sent", channel="sms", destination=mask_mobile(mobile))
+            return
+        fallback_email = get_teacher_otp_email(username)
+        if fallback_email:
+            email_sent, email_err = send_otp_email(fallback_email, otp_code, username)
+            if email_sent:
+                set_otp_delivery_status(delivery_id, "sent", channel="email", destination=mask_email(fallback_email))
+                return
+            err = f"{err}; email failed: {email_err}"
+        set_otp_delivery_status(delivery_id, "failed", error=str(err))
+    except Exception as e:
+        try:
+            set_otp_delivery_status(delivery_id, "failed", error=str(e))
+        except Exception:
+            pass
+    finally:
+        _otp_dispatch_slots.release()
 
-    OTP_STORE.pop(username, None)
-    return jsonify({"success": True, "message": "OTP verified"})
+def reserve_otp_dispatch_slot():
+    # Taken before a new OTP is stored, so a full queue never replaces an OTP
+    # that was already delivered with one that will not be sent.
+    return _otp_dispatch_slots.acquire(blocking=False)
+
+def release_otp_dispatch_slot():
+    _otp_dispatch_slots.release()
+
+def dispatch_teacher_otp(username, mobile, otp_code, teacher_name):
+    """Queue an OTP delivery on a reserved slot; the worker releases the slot when done.
+
+    If this raises, the slot is still held and the caller must release it.
+    """
+    delivery_id = str(ObjectId())
+    now = datetime.utcnow()
+    # The OTP itself is never stored here; only the job's progress.
+    otp_deliveries_col.insert_one({
+        "_id": delivery_id,
+        "kind": "teacher_login",
+        "username": username,
+        "status": "queued",
+        "channel": "sms",
+        "destination": mask_mobile(mobile),
+        "created_at": now,
+        "updated_at": now
+    })
+    get_otp_dispatch_pool().submit(deliver_teacher_otp, delivery_id, username, mobile, otp_code, teacher_name)
+    return delivery_id
 
 @app.route("/teacher/auth/otp/request", methods=["POST"])
 def request_teacher_login_otp():
@@ -2145,37 +3674,50 @@ def request_teacher_login_otp():
     otp_code = f"{random.randint(0, 999999):06d}"
     expires_at = datetime.utcnow() + timedelta(minutes=5)
     otp_key = f"TEACHER::{username}"
-    OTP_STORE[otp_key] = {
-        "otp": otp_code,
-        "expires_at": expires_at,
-        "attempts": 0,
-        "username": username,
-    }
-
-    sent, err = send_textbee_otp(mobile, otp_code, profile.get("teacher_name", "Teacher"))
-    if not sent:
-        fallback_email = get_teacher_otp_email(username)
-        if fallback_email:
-            email_sent, email_err = send_otp_email(fallback_email, otp_code, username)
-            if email_sent:
-                return jsonify({
-                    "success": True,
-                    "message": f"OTP sent to email {mask_email(fallback_email)}",
-                    "channel": "email",
-                    "teacher": teacher_payload
-                })
-            err = f"{err}; email failed: {email_err}"
+    if not reserve_otp_dispatch_slot():
         return jsonify({
             "success": False,
-            "message": f"OTP send failed: {err}",
+            "message": "OTP service is busy, please try again shortly",
             "teacher": teacher_payload
-        }), 500
+        }), 503
+    try:
+        OTP_STORE.put(otp_key, otp_code, expires_at, username=username)
+        delivery_id = dispatch_teacher_otp(username, mobile, otp_code, profile.get("teacher_name", "Teacher"))
+    except Exception:
+        release_otp_dispatch_slot()
+        raise
 
     return jsonify({
         "success": True,
-        "message": f"OTP sent to {mask_mobile(mobile)}",
+        "message": f"OTP is being sent to {mask_mobile(mobile)}",
         "channel": "sms",
+        "delivery_id": delivery_id,
+        "status": "queued",
         "teacher": teacher_payload
+    }), 202
+
+@app.route("/teacher/auth/otp/delivery/<delivery_id>", methods=["GET"])
+def teacher_otp_delivery_status(delivery_id):
+    doc = otp_deliveries_col.find_one({"_id": str(delivery_id)}, {"username": 0})
+    if not doc:
+        return jsonify({"success": False, "message": "Delivery not found"}), 404
+
+    status = doc.get("status", "queued")
+    channel = doc.get("channel", "sms")
+    destination = doc.get("destination", "")
+    if status == "sent":
+        message = f"OTP sent to email {destination}" if channel == "email" else f"OTP sent to {destination}"
+    elif status == "failed":
+        message = f"OTP send failed: {doc.get('error', '')}"
+    else:
+        message = "OTP is being sent"
+    return jsonify({
+        "success": status != "failed",
+        "delivery_id": doc["_id"],
+        "status": status,
+        "channel": channel,
+        "destination": destination,
+        "message": message
     })
 
 @app.route("/teacher/auth/otp/config-check", methods=["GET"])
@@ -2201,26 +3743,7 @@ def verify_teacher_login_otp():
     username = str(data.get("username", "")).strip().upper()
     otp = str(data.get("otp", "")).strip()
     otp_key = f"TEACHER::{username}"
-    rec = OTP_STORE.get(otp_key)
-
-    if not rec:
-        return jsonify({"success": False, "message": "OTP not requested"}), 400
-
-    if datetime.utcnow() > rec["expires_at"]:
-        OTP_STORE.pop(otp_key, None)
-        return jsonify({"success": False, "message": "OTP expired"}), 400
-
-    if rec.get("attempts", 0) >= 5:
-        OTP_STORE.pop(otp_key, None)
-        return jsonify({"success": False, "message": "Too many invalid attempts"}), 429
-
-    if otp != rec.get("otp"):
-        rec["attempts"] = rec.get("attempts", 0) + 1
-        OTP_STORE[otp_key] = rec
-        return jsonify({"success": False, "message": "Invalid OTP"}), 401
-
-    OTP_STORE.pop(otp_key, None)
-    return jsonify({"success": True, "message": "OTP verified"})
+    return otp_verify_response(OTP_STORE.verify(otp_key, otp))
 # ---------------------------
 # Login (admin + teacher)
 # ---------------------------
@@ -2306,6 +3829,155 @@ def login():
     # ---------- INVALID LOGIN ----------
     return jsonify({"success": False, "message": "Invalid username or password"}), 401
 # ---------------------------
+# Teacher name resolution for timetable views
+# ---------------------------
+teacher_name_cache = TTLCache(
+    "teacher_names",
+    ttl_seconds=int(os.environ.get("TEACHER_NAME_CACHE_TTL_SEC", "300")),
+    max_entries=int(os.environ.get("TEACHER_NAME_CACHE_MAX_ENTRIES", "2048"))
+)
+
+def resolve_teacher_names(teacher_ids):
+    # timetable.teacher_id holds either a teachers _id or the 4-digit teacher_id;
+    # unknown ids are resolved with one $in query per form.
+    names = {}
+    object_ids = []
+    codes = []
+    for tid in {str(t).strip() for t in teacher_ids if t is not None and str(t).strip()}:
+        cached = teacher_name_cache.get(tid)
+        if cached is not None:
+            names[tid] = cached
+        elif ObjectId.is_valid(tid):
+            object_ids.append(tid)
+        else:
+            codes.append(tid)
+
+    projection = {"name": 1, "teacher_name": 1, "teacher_id": 1}
+    if object_ids:
+        for doc in teachers_col.find({"_id": {"$in": [ObjectId(t) for t in object_ids]}}, projection):
+            names[str(doc["_id"])] = doc.get("name", "") or doc.get("teacher_name", "")
+    if codes:
+        for doc in teachers_col.find({"teacher_id": {"$in": codes}}, projection):
+            names.setdefault(str(doc.get("teacher_id")), doc.get("name", "") or doc.get("teacher_name", ""))
+
+    for tid in object_ids + codes:
+        names.setdefault(tid, "")
+        teacher_name_cache.set(tid, names[tid])
+    return names
+
+# Sorted /timetable/teachers payload per session
+timetable_teachers_cache = TTLCache(
+    "timetable_teachers",
+    ttl_seconds=int(os.environ.get("TEACHER_NAME_CACHE_TTL_SEC", "300")),
+    max_entries=64
+)
+
+def invalidate_teacher_caches():
+    teacher_name_cache.clear()
+    timetable_teachers_cache.clear()
+
+# ---------------------------
+# Timetable occupancy grid (clash detection)
+# ---------------------------
+TIMETABLE_WEEK_FIELDS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday"]
+TIMETABLE_WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]
+
+def timetable_slot_key(row):
+    return (row.get("period"), row.get("class"), row.get("startDay"), row.get("endDay"))
+
+def group_timetable_rows(rows):
+    # One row per slot key. Exact copies collapse; copies whose weekday cells
+    # differ are returned as conflicts rather than merged, so nothing is rewritten.
+    grouped = {}
+    conflicts = []
+    for row in rows:
+        key = timetable_slot_key(row)
+        kept = grouped.setdefault(key, row)
+        if kept is not row and any(kept.get(fld, "") != row.get(fld, "") for fld in TIMETABLE_WEEK_FIELDS):
+            conflicts.append({
+                "period": key[0],
+                "class": key[1],
+                "startDay": key[2],
+                "endDay": key[3]
+            })
+    return grouped, conflicts
+
+def timetable_row_cells(row):
+    # (period, weekday index) pairs a timetable row occupies; weekday index is 0-based
+    try:
+        period = int(row.get("period", 0))
+    except (TypeError, ValueError):
+        return []
+    return [
+        (period, idx)
+        for idx, fld in enumerate(TIMETABLE_WEEK_FIELDS)
+        if row.get(fld) and str(row.get(fld)).strip()
+    ]
+
+def build_timetable_grid(session):
+    # class x period x weekday -> teacher, built from a single query over the
+    # session's timetable rows. Built per save rather than cached, so saves from
+    # other workers are always seen. The saving teacher's own clashes come from
+    # the submitted rows, so no teacher-side grid is needed.
+    grid = {}
+    projection = {"teacher_id": 1, "class": 1, "period": 1}
+    projection.update({fld: 1 for fld in TIMETABLE_WEEK_FIELDS})
+    for row in timetable_col.find({"session": session}, projection):
+        teacher_id = str(row.get("teacher_id", ""))
+        class_name = row.get("class", "")
+        for period, day in timetable_row_cells(row):
+            grid.setdefault((class_name, period, day), teacher_id)
+    return grid
+
+def find_timetable_clashes(grid, teacher_id, rows):
+    clashes = []
+    booked = {}
+    for row in rows:
+        class_name = row.get("class", "")
+        for period, day in timetable_row_cells(row):
+            holder = grid.get((class_name, period, day))
+            if holder is not None and holder != teacher_id:
+                clashes.append({
+                    "type": "class_busy",
+                    "class": class_name,
+                    "period": period,
+                    "day": TIMETABLE_WEEKDAYS[day],
+                    "teacher_id": holder
+                })
+            other_class = booked.get((period, day))
+            if other_class is not None and other_class != class_name:
+                clashes.append({
+                    "type": "teacher_busy",
+                    "class": class_name,
+                    "period": period,
+                    "day": TIMETABLE_WEEKDAYS[day],
+                    "other_class": other_class
+                })
+            booked[(period, day)] = class_name
+    return clashes
+
+_timetable_transactions = True
+
+def write_timetable_ops(ops):
+    # with_transaction retries TransientTransactionError and
+    # UnknownTransactionCommitResult for us.
+    global _timetable_transactions
+    if _timetable_transactions:
+        try:
+            with client.start_session() as db_session:
+                db_session.with_transaction(
+                    lambda s: timetable_col.bulk_write(ops, ordered=True, session=s)
+                )
+            return
+        except OperationFailure as e:
+            # A standalone mongod (local dev) has no transactions (IllegalOperation);
+            # fall back to a plain ordered bulk write for the rest of the process.
+            if e.code != 20:
+                raise
+            _timetable_transactions = False
+    timetable_col.bulk_write(ops, ordered=True)
+
+# ---------------------------
 # Get timetable for a teacher
 # ---------------------------
 @app.route("/timetable/get")
@@ -2347,11 +4019,8 @@ def set_timetable():
     if not session or not teacher_id:
         return jsonify({"success": False, "message": "Missing data"}), 400
 
-    # delete existing entries for this teacher+session (mirror sqlite behavior)
-    timetable_col.delete_many({"session": session, "teacher_id": teacher_id})
-
-    # insert each row (supports multiple rows with same period if UI sends them)
-    to_insert = []
+    # build rows; one slot per (period, class, startDay, endDay)
+    submitted = []
     for periodData in timetable_list:
         # periodData expected keys: period, class, Monday..Saturday, startDay, endDay
         doc = {
@@ -2371,15 +4040,99 @@ def set_timetable():
         # skip rows without class (keeps same behavior)
         if not doc["class"]:
             continue
-        to_insert.append(doc)
+        submitted.append(doc)
+    wanted, conflicts = group_timetable_rows(submitted)
+    if conflicts:
+        return jsonify({
+            "success": False,
+            "message": "Duplicate timetable rows with different subjects",
+            "conflicts": conflicts
+        }), 400
 
-    if to_insert:
+    # Check-then-write: two concurrent saves for different teachers can still both
+    # take the same class/period/day, because the unique slot index only covers
+    # one teacher's rows, not class x period x day.
+    grid = build_timetable_grid(session)
+    clashes = find_timetable_clashes(grid, str(teacher_id), wanted.values())
+    if clashes and not to_bool(data.get("force"), False):
+        return jsonify({
+            "success": False,
+            "message": "Timetable clashes found",
+            "clashes": clashes
+        }), 409
+
+    # diff against stored rows: only changed slots are written
+    stored = {}
+    ops = []
+    for row in timetable_col.find({"session": session, "teacher_id": teacher_id}):
+        key = timetable_slot_key(row)
+        if key in stored:
+            ops.append(DeleteOne({"_id": row["_id"]}))
+        else:
+            stored[key] = row
+
+    inserted = updated = deleted = 0
+    for key, doc in wanted.items():
+        row = stored.pop(key, None)
+        if row is None:
+            ops.append(InsertOne(doc))
+            inserted += 1
+            continue
+        changes = {fld: doc[fld] for fld in TIMETABLE_WEEK_FIELDS if row.get(fld) != doc[fld]}
+        if changes:
+            ops.append(UpdateOne({"_id": row["_id"]}, {"$set": changes}))
+            updated += 1
+    for row in stored.values():
+        ops.append(DeleteOne({"_id": row["_id"]}))
+    deleted = len(ops) - inserted - updated
+
+    if ops:
         try:
-            timetable_col.insert_many(to_insert, ordered=False)
-        except Exception:
-            pass
+            write_timetable_ops(ops)
+        except Exception as e:
+            return jsonify({"success": False, "message": f"Failed to save timetable: {str(e)}"}), 500
+        timetable_teachers_cache.pop(session)
+
+    return jsonify({
+        "success": True,
+        "message": "Timetable saved successfully",
+        "inserted": inserted,
+        "updated": updated,
+        "deleted": deleted,
+        "clashes": clashes
+    })
+
+
+@app.cli.command("dedupe-timetable")
+def dedupe_timetable():
+    """Delete exact copies of timetable rows, then make the slot index unique.
 
-    return jsonify({"success": True, "message": "Timetable saved successfully"})
+    Run with: flask --app app dedupe-timetable
+    Rows that share a slot key but hold different subjects are listed and left
+    untouched; fix them from the timetable screen and run this again.
+    """
+    groups = {}
+    for row in timetable_col.find().sort("_id", ASCENDING):
+        key = (row.get("session"), row.get("teacher_id")) + timetable_slot_key(row)
+        groups.setdefault(key, []).append(row)
+
+    copies = []
+    conflicting = []
+    for key, rows in groups.items():
+        if len(rows) < 2:
+            continue
+        first = rows[0]
+        for row in rows[1:]:
+            if all(row.get(fld, "") == first.get(fld, "") for fld in TIMETABLE_WEEK_FIELDS):
+                copies.append(row["_id"])
+            else:
+                conflicting.append(key)
+    for i in range(0, len(copies), 1000):
+        timetable_col.delete_many({"_id": {"$in": copies[i:i + 1000]}})
+    for key in dict.fromkeys(conflicting):
+        print(f"Conflicting rows (session, teacher, period, class, startDay, endDay): {key}")
+    unique = ensure_timetable_unique_index()
+    print(f"Deleted {len(copies)} duplicate timetable rows; unique index {'in place' if unique else 'NOT created'}")
 # PART 4/4
 # ---------------------------
 # CLASSWISE TIMETABLE (/timetable/classwise)
@@ -2397,28 +4150,15 @@ def timetable_classwise():
         }), 400
 
     # Fetch all rows for this class+session
-    cursor = timetable_col.find(
+    rows = list(timetable_col.find(
         {"session": session, "class": class_name}
-    ).sort("period", ASCENDING)
+    ).sort("period", ASCENDING))
+    teacher_names = resolve_teacher_names(row.get("teacher_id") for row in rows)
 
     output = []
 
-    for row in cursor:
-
-        # ------------- FETCH TEACHER NAME CORRECTLY -------------
-        teacher_name = ""
-        teacher_id = str(row.get("teacher_id", "")).strip()
-
-        if teacher_id:
-            # CASE 1: valid ObjectId
-            if ObjectId.is_valid(teacher_id):
-                t_doc = teachers_col.find_one({"_id": ObjectId(teacher_id)})
-            else:
-                # CASE 2: teacher_id stored as normal string
-                t_doc = teachers_col.find_one({"teacher_id": teacher_id})
-
-            if t_doc:
-                teacher_name = t_doc.get("name", "")
+    for row in rows:
+        teacher_name = teacher_names.get(str(row.get("teacher_id", "")).strip(), "")
 
         # ------------- BUILD WEEKDAY ENTRIES -------------
         output.append({
@@ -2455,18 +4195,81 @@ def get_used_days():
     if not session or not class_name or not period:
         return jsonify({"success": False, "used_days": []}), 400
 
-    cursor = timetable_col.find({"session": session, "class": class_name, "period": period})
+    projection = {fld: 1 for fld in TIMETABLE_WEEK_FIELDS}
+    projection["period"] = 1
     used_days = set()
-    # weekday mapping as in sqlite code
-    week_fields = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday"]
-    for r in cursor:
-        for idx, fld in enumerate(week_fields):
-            val = r.get(fld)
-            if val and str(val).strip():
-                used_days.add(idx + 1)
+    for row in timetable_col.find({"session": session, "class": class_name, "period": period}, projection):
+        used_days.update(day + 1 for _, day in timetable_row_cells(row))
     return jsonify({"success": True, "used_days": sorted(list(used_days))})
 
 
+# ---------------------------
+# Whole-school timetable matrix (/timetable/matrix)
+# Cells hold 1-based indexes into "slots" (0 = free); each slot is
+# [class index, teacher index, subject index] into the lookup tables.
+# ---------------------------
+@app.route("/timetable/matrix")
+def timetable_matrix():
+    session = request.args.get("session")
+    if not session:
+        return jsonify({"success": False, "message": "Missing session"}), 400
+
+    projection = {"teacher_id": 1, "class": 1, "period": 1}
+    projection.update({fld: 1 for fld in TIMETABLE_WEEK_FIELDS})
+    rows = [r for r in timetable_col.find({"session": session}, projection) if r.get("class")]
+
+    classes = sorted({r.get("class") for r in rows}, key=class_sort_key)
+    names = resolve_teacher_names(r.get("teacher_id") for r in rows)
+    teacher_ids = sorted({str(r.get("teacher_id", "")).strip() for r in rows}, key=lambda t: (names.get(t, ""), t))
+    periods = sorted({period for r in rows for period, _ in timetable_row_cells(r)})
+
+    class_index = {c: i for i, c in enumerate(classes)}
+    teacher_index = {t: i for i, t in enumerate(teacher_ids)}
+    period_index = {p: i for i, p in enumerate(periods)}
+    days = len(TIMETABLE_WEEK_FIELDS)
+
+    subjects = []
+    subject_index = {}
+    slots = []
+    slot_index = {}
+    class_grid = [[[0] * days for _ in periods] for _ in classes]
+    teacher_grid = [[[0] * days for _ in periods] for _ in teacher_ids]
+    conflicts = 0
+
+    for r in rows:
+        c = class_index[r.get("class")]
+        t = teacher_index[str(r.get("teacher_id", "")).strip()]
+        for period, day in timetable_row_cells(r):
+            subject = clean_text(r.get(TIMETABLE_WEEK_FIELDS[day]))
+            if subject not in subject_index:
+                subject_index[subject] = len(subjects)
+                subjects.append(subject)
+            slot_key = (c, t, subject_index[subject])
+            if slot_key not in slot_index:
+                slot_index[slot_key] = len(slots)
+                slots.append(list(slot_key))
+            cell = slot_index[slot_key] + 1
+            p = period_index[period]
+            if class_grid[c][p][day] or teacher_grid[t][p][day]:
+                conflicts += 1
+            if not class_grid[c][p][day]:
+                class_grid[c][p][day] = cell
+            if not teacher_grid[t][p][day]:
+                teacher_grid[t][p][day] = cell
+
+    return jsonify({
+        "success": True,
+        "days": TIMETABLE_WEEKDAYS,
+        "periods": periods,
+        "classes": classes,
+        "teachers": [{"id": t, "name": names.get(t, "")} for t in teacher_ids],
+        "subjects": subjects,
+        "slots": slots,
+        "class_grid": class_grid,
+        "teacher_grid": teacher_grid,
+        "conflicts": conflicts
+    })
+
 # ---------------------------
 # Get distinct teachers for a session timetable (/timetable/teachers)
 # ---------------------------
@@ -2476,22 +4279,13 @@ def get_timetable_teachers():
     if not session:
         return jsonify({"success": False, "teachers": []}), 400
 
-    teacher_ids = timetable_col.distinct("teacher_id", {"session": session})
-    teachers = []
-    for tid in teacher_ids:
-        name = ""
-        try:
-            if ObjectId.is_valid(str(tid)):
-                t_doc = teachers_col.find_one({"_id": ObjectId(str(tid))})
-            else:
-                t_doc = teachers_col.find_one({"teacher_id": str(tid)})
-            if t_doc:
-                name = t_doc.get("name", "") or t_doc.get("teacher_name", "")
-        except Exception:
-            name = ""
-        teachers.append({"id": str(tid), "name": name})
-
-    teachers.sort(key=lambda t: (t.get("name") or "", t.get("id") or ""))
+    teachers = timetable_teachers_cache.get(session)
+    if teachers is None:
+        teacher_ids = timetable_col.distinct("teacher_id", {"session": session})
+        names = resolve_teacher_names(teacher_ids)
+        teachers = [{"id": str(tid), "name": names.get(str(tid).strip(), "")} for tid in teacher_ids]
+        teachers.sort(key=lambda t: (t.get("name") or "", t.get("id") or ""))
+        timetable_teachers_cache.set(session, teachers)
     return jsonify({"success": True, "teachers": teachers})
 
 
@@ -2919,6 +4713,9 @@ def delete_notice(notice_id):
 # Attendance collection
 # ---------------------------
 attendance_col = db["attendance"]
+attendance_col.create_index([("session_key", ASCENDING), ("class_name", ASCENDING), ("date", ASCENDING)])
+# Serves the legacy branch of session_key_filter() for docs without session_key.
+attendance_col.create_index([("session", ASCENDING), ("class_name", ASCENDING), ("date", ASCENDING)])
 
 # ---------------------------
 # Add or update attendance
@@ -2947,8 +4744,10 @@ def save_attendance():
     if not session or not class_name or not date or not attendance_list:
         return jsonify({"success": False, "message": "Missing fields"}), 400
 
+    session_key = canonical_session(session)
+
     # Remove old attendance for same class+date
-    attendance_col.delete_many({"session": session, "class_name": class_name, "date": date})
+    attendance_col.delete_many({**session_key_filter(session_key), "class_name": class_name, "date": date})
 
     # Insert new attendance
     to_insert = []
@@ -2960,6 +4759,7 @@ def save_attendance():
         if student_id and status in ["present", "absent", "leave"]:
             to_insert.append({
                 "session": session,
+                "session_key": session_key,
                 "class_name": class_name,
                 "date": date,
                 "student_id": student_id,
@@ -2991,7 +4791,7 @@ def list_attendance():
     if not session or not class_name or not date:
         return jsonify({"success": False, "attendance": [], "message": "Missing parameters"}), 400
 
-    cursor = attendance_col.find({"session": session, "class_name": class_name, "date": date})
+    cursor = attendance_col.find({**session_key_filter(session), "class_name": class_name, "date": date})
     records = []
     for att in cursor:
         sid = normalize_student_id(att.get("student_id"))
@@ -3022,11 +4822,10 @@ def list_attendance_monthly():
     if not session or not class_name or not month:
         return jsonify({"success": False, "attendance": [], "message": "Missing parameters"}), 400
 
-    sessions = session_variants(session)
     # match any date within the month
     month_prefix = str(month).strip()
     cursor = attendance_col.find({
-        "session": {"$in": sessions} if sessions else session,
+        **session_key_filter(session),
         "class_name": class_name,
         "date": {"$regex": f"^{month_prefix}-"}
     })